@@ -1,20 +1,50 @@
-import json
+import multiprocessing
 import os
 import shutil
 import subprocess
 import sys
 import wave
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from bisect import bisect_right
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import count, dropwhile, takewhile
 from pathlib import Path
-from typing import Callable
+from threading import BoundedSemaphore
+from typing import Callable, Iterable, Iterator
 
 import cv2
+import numpy as np
 from rich.progress import Progress, SpinnerColumn, TextColumn, TimeElapsedColumn
 
 import aic51.packages.constant as constant
 from aic51.packages.config import GlobalConfig
 from aic51.packages.logger import logger
-from aic51.packages.utils.files import get_path
+from aic51.packages.media import (
+    ClipWriter,
+    DuplicateFilter,
+    FFmpegIngest,
+    FrameRingBuffer,
+    ImageWriter,
+    KeyframeSelectorFactory,
+    create_image_store_writer,
+    dhash,
+    find_duplicates,
+    iter_keyframe_ids,
+    load_media_info,
+    load_storyboard_index,
+    merge_clip_stores,
+    open_image_store,
+    probe_has_audio,
+    probe_media_info,
+    read_frames,
+    remove_images,
+    save_audio_clips,
+    save_duplicates,
+    save_media_info,
+    save_storyboard,
+    split_chunks,
+)
+from aic51.packages.utils import Manifest, ProgressListener, fingerprint, get_path, hash_file
 
 from .command import BaseCommand
 
@@ -23,6 +53,29 @@ class AddCommand(BaseCommand):
     SUPPORTED_EXT = [
         ".mp4",
     ]
+    KEYFRAME_CONFIG_KEYS = [
+        "default_size",
+        "max_scene_length",
+        "keyframe_resize_ratio",
+        "thumbnail_resize_ratio",
+        "clip_length",
+        "clip_format",
+        "clip_frame_size",
+        "image_format",
+        "dedup_distance",
+        "keyframe_selector",
+        "scene_threshold",
+        "min_scene_length",
+    ]
+    STORYBOARD_CONFIG_KEYS = [
+        "storyboard_tile_width",
+        "storyboard_columns",
+        "storyboard_rows",
+    ]
+    COMPRESS_CONFIG_KEYS = [
+        "default_size",
+        "compress_size_rate",
+    ]
 
     def __init__(self, *args, **kwargs):
         super(AddCommand, self).__init__(*args, **kwargs)
@@ -89,6 +142,13 @@ class AddCommand(BaseCommand):
             action="store_true",
             help="Compress the video right after loading",
         )
+        parser.add_argument(
+            "-s",
+            "--single-pass",
+            dest="do_single_pass",
+            action="store_true",
+            help="Decode each video once to compress it, extract its audio and its keyframes",
+        )
 
         parser.set_defaults(func=self)
 
@@ -103,6 +163,7 @@ class AddCommand(BaseCommand):
         do_clip: bool,
         do_compress: bool,
         do_compress_first: bool,
+        do_single_pass: bool,
         verbose: bool,
         *args,
         **kwargs,
@@ -136,6 +197,7 @@ class AddCommand(BaseCommand):
             do_clip,
             do_compress,
             do_compress_first,
+            do_single_pass,
             verbose,
         )
 
@@ -149,10 +211,17 @@ class AddCommand(BaseCommand):
         do_clip: bool,
         do_compress: bool,
         do_compress_first: bool,
+        do_single_pass: bool,
         verbose: bool,
     ):
         max_workers_ratio = GlobalConfig.get("max_workers_ratio") or 0
-        max_workers = max(1, max_workers_ratio * (os.cpu_count() or 0))
+        max_workers = max(1, int(max_workers_ratio * (os.cpu_count() or 0)))
+        ffmpeg_workers = max(1, GlobalConfig.get("add", "ffmpeg_workers") or 1)
+
+        # Frame loops run in processes to avoid the GIL, ffmpeg stages only wait on subprocesses
+        mp_context = multiprocessing.get_context("spawn")
+        ffmpeg_semaphore = BoundedSemaphore(ffmpeg_workers)
+        manifest = Manifest(self._work_dir / constant.MANIFEST_PATH)
         with (
             Progress(
                 TextColumn("{task.fields[name]}"),
@@ -162,7 +231,10 @@ class AddCommand(BaseCommand):
                 TimeElapsedColumn(),
                 disable=not verbose,
             ) as progress,
-            ThreadPoolExecutor(max_workers) as executor,
+            mp_context.Manager() as manager,
+            ProgressListener(progress, manager.Queue()) as progress_listener,
+            ProcessPoolExecutor(max_workers, mp_context=mp_context) as process_executor,
+            ThreadPoolExecutor(max_workers + ffmpeg_workers) as executor,
         ):
 
             def show_progress(task_id):
@@ -174,34 +246,90 @@ class AddCommand(BaseCommand):
                     name=video_path.name,
                 )
                 try:
-                    status_ok, output_path, video_id = self._load_video(
-                        video_path,
-                        do_move,
-                        do_overwrite,
-                        show_progress(task_id),
-                    )
+                    video_id = video_path.stem
+                    output_path = self._work_dir / constant.VIDEO_DIR / f"{video_id}{video_path.suffix}"
+
+                    # Stages are redone when the source or their config changed, or when they did not complete
+                    stage_fingerprints = self._get_stage_fingerprints(do_keyframe, do_audio, do_clip, do_compress)
+                    source_hash = hash_file(video_path) if video_path.exists() else None
+                    if output_path.exists():
+                        existing_stages = self._get_existing_stages(video_id, do_clip, stage_fingerprints)
+                        manifest.seed(video_id, source_hash, existing_stages)
+                    if source_hash is not None:
+                        manifest.update_source(video_id, source_hash)
+
+                    redo_stages = set()
+                    for stage, stage_fingerprint in stage_fingerprints.items():
+                        if do_overwrite or not manifest.is_done(video_id, stage, stage_fingerprint):
+                            redo_stages.add(stage)
+                    if not output_path.exists():
+                        redo_stages.add("load")
+                    # The saved video is the one compressed
+                    if do_compress and ("load" in redo_stages or "compress" in redo_stages):
+                        redo_stages.update(["load", "compress"])
+                    # Storyboards are built from the thumbnails
+                    if "keyframes" in redo_stages:
+                        redo_stages.add("storyboard")
+
+                    def run_stage(stage: str, func: Callable, *args):
+                        manifest.start(video_id, stage)
+                        func(*args)
+                        manifest.done(video_id, stage, stage_fingerprints[stage])
+
+                    if do_single_pass:
+                        ingest_stages = redo_stages - {"storyboard"}
+                        if len(ingest_stages) > 0:
+                            for stage in ingest_stages:
+                                manifest.start(video_id, stage)
+                            with ffmpeg_semaphore:
+                                process_executor.submit(
+                                    self._ingest_video,
+                                    video_path,
+                                    do_move,
+                                    do_audio,
+                                    do_clip,
+                                    ingest_stages,
+                                    progress_listener.reporter(task_id),
+                                ).result()
+                            for stage in ingest_stages:
+                                manifest.done(video_id, stage, stage_fingerprints[stage])
+                        if "storyboard" in redo_stages:
+                            run_stage("storyboard", self._build_storyboard, video_id, show_progress(task_id))
+                        progress.remove_task(task_id)
+                        return
+
+                    if "load" in redo_stages:
+                        run_stage("load", self._load_video, video_path, do_move, show_progress(task_id))
 
                     if do_move:
                         video_path = output_path
 
-                    if status_ok and do_compress and do_compress_first:
-                        self._compress_video(video_id, show_progress(task_id))
+                    if "compress" in redo_stages and do_compress_first:
+                        with ffmpeg_semaphore:
+                            run_stage("compress", self._compress_video, video_id, show_progress(task_id))
 
-                    if do_audio:
-                        self._extract_audio(video_path, do_overwrite, show_progress(task_id))
+                    if "audio" in redo_stages:
+                        with ffmpeg_semaphore:
+                            run_stage("audio", self._extract_audio, video_path, show_progress(task_id))
 
-                    if do_keyframe:
-                        self._extract_keyframes(
+                    if "keyframes" in redo_stages:
+                        run_stage(
+                            "keyframes",
+                            self._extract_keyframes,
                             output_path,
                             video_path,
-                            do_overwrite,
                             do_audio,
                             do_clip,
-                            show_progress(task_id),
+                            progress_listener.reporter(task_id),
+                            process_executor,
                         )
 
-                    if status_ok and do_compress and not do_compress_first:
-                        self._compress_video(video_id, show_progress(task_id))
+                    if "storyboard" in redo_stages:
+                        run_stage("storyboard", self._build_storyboard, video_id, show_progress(task_id))
+
+                    if "compress" in redo_stages and not do_compress_first:
+                        with ffmpeg_semaphore:
+                            run_stage("compress", self._compress_video, video_id, show_progress(task_id))
 
                     progress.remove_task(task_id)
                 except Exception as e:
@@ -217,277 +345,588 @@ class AddCommand(BaseCommand):
             for f in futures:
                 f.result()
 
-    def _load_video(
-        self, video_path: Path, do_move: bool, do_overwrite: bool, update_progress: Callable
-    ):
+    def _get_stage_fingerprints(self, do_keyframe: bool, do_audio: bool, do_clip: bool, do_compress: bool):
+        # Only the config changing the outputs of a stage is part of its fingerprint
+        stage_fingerprints = {"load": fingerprint()}
+        if do_audio:
+            stage_fingerprints["audio"] = fingerprint()
+        if do_keyframe:
+            stage_fingerprints["keyframes"] = fingerprint(
+                do_audio,
+                do_clip,
+                [GlobalConfig.get("add", k) for k in self.KEYFRAME_CONFIG_KEYS],
+            )
+            stage_fingerprints["storyboard"] = fingerprint(
+                [GlobalConfig.get("add", k) for k in self.STORYBOARD_CONFIG_KEYS],
+            )
+        if do_compress:
+            stage_fingerprints["compress"] = fingerprint(
+                [GlobalConfig.get("add", k) for k in self.COMPRESS_CONFIG_KEYS],
+            )
+
+        return stage_fingerprints
+
+    def _get_existing_stages(self, video_id: str, do_clip: bool, stage_fingerprints: dict[str, str]):
+        # Outputs of a workspace without a manifest are kept like add did before it, with the current config
+        keyframe_dir = self._work_dir / constant.KEYFRAME_DIR / video_id
+        video_clips_dir = self._work_dir / constant.VIDEO_CLIP_DIR / video_id
+        raw_video_path = self._work_dir / constant.VIDEO_DIR / f"_{video_id}.mp4"
+
+        existing_stages = {"load": not raw_video_path.exists()}
+        existing_stages["compress"] = existing_stages["load"]
+        existing_stages["audio"] = (self._work_dir / constant.AUDIO_DIR / f"{video_id}.wav").exists()
+        existing_stages["keyframes"] = (
+            keyframe_dir.exists()
+            and any(keyframe_dir.iterdir())
+            and (not do_clip or (video_clips_dir.exists() and any(video_clips_dir.iterdir())))
+        )
+        existing_stages["storyboard"] = (
+            load_storyboard_index(self._work_dir / constant.STORYBOARD_DIR / video_id) is not None
+        )
+
+        return {
+            stage: stage_fingerprint
+            for stage, stage_fingerprint in stage_fingerprints.items()
+            if existing_stages.get(stage, False)
+        }
+
+    def _load_video(self, video_path: Path, do_move: bool, update_progress: Callable):
         update_progress(description=f"Saving video", completed=0, total=1)
 
         video_id = video_path.stem
         output_path = self._work_dir / constant.VIDEO_DIR / f"{video_id}{video_path.suffix}"
 
-        if output_path.exists() and not do_overwrite:
-            return 0, output_path, video_id
-
         output_path.parent.mkdir(parents=True, exist_ok=True)
         if do_move:
             shutil.move(video_path, output_path)
         else:
             shutil.copy(video_path, output_path)
 
-        self._extract_video_info(output_path)
+        self._get_media_info(output_path)
 
         update_progress(advance=1)
 
-        return 1, output_path, video_id
-
     def _extract_keyframes(
         self,
         video_path: Path,
         raw_video_path: Path,
-        do_overwrite: bool,
         do_audio: bool,
         do_clip: bool,
         update_progress: Callable,
+        executor: Executor | None = None,
     ):
-        audio_path = self._work_dir / constant.AUDIO_DIR / f"{video_path.stem}.wav"
+        self._prepare_keyframe_dirs(video_path, do_audio, do_clip)
+
+        update_progress(description=f"Finding keyframes", completed=0, total=1)
+        media_info = self._get_media_info(video_path, raw_video_path)
+        keyframes_list = media_info[constant.KEYFRAMES_KEY]
+        video_fps = media_info[constant.FPS_KEY]
+        update_progress(advance=1)
+
+        update_progress(description=f"Selecting keyframes", completed=0, total=1)
+        scene_starts = self._select_scene_starts(video_path, media_info)
+        update_progress(advance=1)
+
+        chunks = self._split_chunks(media_info)
+
+        update_progress(description=f"Extracting keyframes", completed=0, total=len(scene_starts))
+
+        args = (video_path, keyframes_list, scene_starts, video_fps, do_clip)
+        if executor is None:
+            results = [self._extract_keyframes_chunk(*args, start, end, update_progress) for start, end in chunks]
+        else:
+            futures = []
+            for start, end in chunks:
+                futures.append(executor.submit(self._extract_keyframes_chunk, *args, start, end, update_progress))
+            results = [f.result() for f in futures]
+
+        clip_frame_ids = []
+        duplicates = {}
+        frame_hashes = {}
+        for chunk_clip_frame_ids, chunk_duplicates, chunk_frame_hashes in results:
+            clip_frame_ids += chunk_clip_frame_ids
+            duplicates.update(chunk_duplicates)
+            frame_hashes.update(chunk_frame_hashes)
+
+        # Chunks only hash their keyframes, duplicates are found over the whole video like a sequential pass
+        dedup_distance = GlobalConfig.get("add", "dedup_distance")
+        if len(frame_hashes) > 0 and dedup_distance is not None:
+            duplicates = find_duplicates(frame_hashes, dedup_distance)
+            self._remove_keyframes(video_path, set(duplicates.keys()), do_clip)
+            clip_frame_ids = [frame_id for frame_id in clip_frame_ids if frame_id not in duplicates]
+
+        self._save_duplicates(video_path, duplicates)
+        if do_clip and (GlobalConfig.get("add", "clip_format") or "packed") == "packed":
+            video_clips_dir = self._work_dir / constant.VIDEO_CLIP_DIR / f"{video_path.stem}"
+            merge_clip_stores(
+                video_clips_dir, "video", GlobalConfig.get("add", "clip_frame_size"), set(duplicates.keys())
+            )
+        if do_clip and do_audio:
+            self._extract_audio_clips(video_path, clip_frame_ids, video_fps)
+
+    def _prepare_keyframe_dirs(self, video_path: Path, do_audio: bool, do_clip: bool):
         keyframe_dir = self._work_dir / constant.KEYFRAME_DIR / f"{video_path.stem}"
         thumbnail_dir = self._work_dir / constant.THUMBNAIL_DIR / f"{video_path.stem}"
         video_clips_dir = self._work_dir / constant.VIDEO_CLIP_DIR / f"{video_path.stem}"
-        audio_clips_dir = self._work_dir / constant.AUDIO_CLIP_DIR / f"{video_path.stem}"
+        audio_clips_path = self._work_dir / constant.AUDIO_CLIP_DIR / f"{video_path.stem}.json"
+        duplicates_path = self._work_dir / constant.DUPLICATE_DIR / f"{video_path.stem}.json"
 
+        # Outputs of a previous run are removed, they can be incomplete
         if keyframe_dir.exists():
-            if do_overwrite:
-                shutil.rmtree(keyframe_dir)
-                if thumbnail_dir.exists():
-                    shutil.rmtree(thumbnail_dir)
-                if video_clips_dir.exists():
-                    shutil.rmtree(video_clips_dir)
-            else:
-                return
+            shutil.rmtree(keyframe_dir)
+        if thumbnail_dir.exists():
+            shutil.rmtree(thumbnail_dir)
+        if video_clips_dir.exists():
+            shutil.rmtree(video_clips_dir)
+        if audio_clips_path.exists():
+            os.remove(audio_clips_path)
+        if duplicates_path.exists():
+            os.remove(duplicates_path)
 
         keyframe_dir.mkdir(parents=True, exist_ok=True)
         thumbnail_dir.mkdir(parents=True, exist_ok=True)
         if do_clip:
             video_clips_dir.mkdir(parents=True, exist_ok=True)
             if do_audio:
-                audio_clips_dir.mkdir(parents=True, exist_ok=True)
+                audio_clips_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def _select_scene_starts(self, video_path: Path, media_info: dict):
+        keyframe_selector = GlobalConfig.get("add", "keyframe_selector") or "iframe"
+        scene_threshold = GlobalConfig.get("add", "scene_threshold")
+        scene_threshold = 0.3 if scene_threshold is None else scene_threshold
+        min_scene_length = GlobalConfig.get("add", "min_scene_length")
+        min_scene_length = 0.5 if min_scene_length is None else min_scene_length  # in seconds
+
+        keyframe_selector_cls = KeyframeSelectorFactory.get(keyframe_selector)
+        if keyframe_selector_cls is None:
+            raise RuntimeError(f"keyframe_selector={keyframe_selector} is invalid")
+
+        selector = keyframe_selector_cls(threshold=scene_threshold, min_scene_length=min_scene_length)
+        return selector.select(video_path, media_info)
+
+    def _split_chunks(self, media_info: dict):
+        seek_keyframes = GlobalConfig.get("add", "seek_keyframes")
+        chunk_length = GlobalConfig.get("add", "chunk_length")  # in seconds
+
+        # Chunks can only be decoded independently by seeking
+        if seek_keyframes is False or not chunk_length:
+            return [(0, None)]
+
+        return split_chunks(
+            media_info[constant.KEYFRAMES_KEY],
+            media_info[constant.NUM_FRAMES_KEY],
+            chunk_length * media_info[constant.FPS_KEY],
+        )
 
-        update_progress(description=f"Finding keyframes", completed=0, total=1)
-        keyframes_list = self._get_keyframes_list(raw_video_path)
-        update_progress(advance=1)
-        video_fps = self._get_fps(video_path)
+    def _extract_keyframes_chunk(
+        self,
+        video_path: Path,
+        keyframes_list: list[int],
+        scene_starts: list[int],
+        video_fps: int,
+        do_clip: bool,
+        start: int,
+        end: int | None,
+        update_progress: Callable,
+        frame_reader: Callable[[Iterable[int]], Iterator[tuple[int, np.ndarray]]] | None = None,
+    ):
+        video_clips_dir = self._work_dir / constant.VIDEO_CLIP_DIR / f"{video_path.stem}"
 
         max_scene_length = GlobalConfig.get("add", "max_scene_length") or 1  # in seconds
         max_scene_length = max_scene_length * video_fps  # in frames
         keyframe_ratio = GlobalConfig.get("add", "keyframe_resize_ratio") or 0.5
-        thumbnail_ratio = GlobalConfig.get("add", "thumbnail_resize_ratio") or 0.25
         clip_length = GlobalConfig.get("add", "clip_length") or 7  # in seconds
-
-        video_length = clip_length * video_fps  # in frames
-        video_clip_fps = max(1, int(1 / (video_length / video_fps)))
-        video_clip_interval = video_length // 7
-
-        if do_audio:
-            with wave.open(str(audio_path), "rb") as f:
-                wave_params = f.getparams()
-                audio_fps = f.getframerate()
-                audio_frames = f.readframes(f.getnframes())
-                audio_frame_size = f.getsampwidth() * f.getnchannels()
-
-            audio_length = clip_length * audio_fps  # in frames
-            audio_clip_interval = audio_length // 7
-        else:
-            wave_params = audio_fps = audio_frames = audio_frame_size = audio_length = (
-                audio_clip_interval
-            ) = None
-
-        update_progress(description=f"Extracting keyframes", completed=0, total=len(keyframes_list))
-
-        video_frames = []
-        cap = cv2.VideoCapture(str(video_path))
-        _frame_counter = 0
-        scene_length = 0
         default_size = GlobalConfig.get("add", "default_size") or [1280, 720]
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-
-            default_size_frame = cv2.resize(frame, default_size)
+        max_buffer_memory = GlobalConfig.get("add", "frame_buffer_memory") or 2048  # in MB
+        seek_keyframes = GlobalConfig.get("add", "seek_keyframes")
+        seek_keyframes = True if seek_keyframes is None else seek_keyframes
+        clip_format = GlobalConfig.get("add", "clip_format") or "packed"
+        clip_frame_size = GlobalConfig.get("add", "clip_frame_size")
+        dedup_distance = GlobalConfig.get("add", "dedup_distance")
+
+        # Clips shorter than 7 frames use every frame around their keyframe
+        video_length = max(1, int(clip_length * video_fps))  # in frames
+        video_clip_fps = max(1, int(1 / (video_length / video_fps)))
+        video_clip_interval = max(1, video_length // 7)
 
-            resized_frame = cv2.resize(
-                default_size_frame, None, fx=keyframe_ratio, fy=keyframe_ratio
-            )
-            video_frames.append(resized_frame)
+        # I-frames are only used to seek, scenes are the ones of the keyframe selector
+        scene_starts_set = set(scene_starts)
 
-            if len(video_frames) >= 2 * video_length:
-                video_frames.pop(0)
+        # A whole video is deduplicated as it is read. Chunks of a video keep every keyframe and return their hashes,
+        # the keyframes found duplicated over the whole video are removed once every chunk is done
+        duplicate_filter = None
+        frame_hashes = {}
+        if dedup_distance is not None and start == 0 and end is None:
+            duplicate_filter = DuplicateFilter(dedup_distance)
+        duplicates = duplicate_filter.duplicates if duplicate_filter is not None else {}
 
-            video_frame_counter = _frame_counter - video_length + 1
+        def keep_keyframe(frame_id, keyframe):
+            if duplicate_filter is not None:
+                return duplicate_filter.keep(frame_id, keyframe)
+            if dedup_distance is not None:
+                frame_hashes[frame_id] = dhash(keyframe)
+            return True
 
-            if video_frame_counter in keyframes_list:
-                update_progress(advance=1)
+        # Selected frames are computed over the whole video so that chunks match a sequential pass
+        frame_ids = dropwhile(lambda k: k < start, iter_keyframe_ids(scene_starts, max_scene_length))
+        if end is not None:
+            frame_ids = takewhile(lambda k: k < end, frame_ids)
 
-            if scene_length >= max_scene_length or video_frame_counter in keyframes_list:
-                current_frame = video_frames[-video_length]
+        if frame_reader is None:
 
-                cv2.imwrite(
-                    str(keyframe_dir / f"{video_frame_counter:06d}.jpg"),
-                    current_frame,
-                    [cv2.IMWRITE_JPEG_QUALITY, 50],
-                )
+            def frame_reader(frame_ids):
+                return read_frames(video_path, frame_ids, keyframes_list, seek_keyframes)
 
-                thumbnail = cv2.resize(current_frame, None, fx=thumbnail_ratio, fy=thumbnail_ratio)
-                cv2.imwrite(
-                    str(thumbnail_dir / f"{video_frame_counter:06d}.jpg"),
-                    thumbnail,
-                    [cv2.IMWRITE_JPEG_QUALITY, 50],
-                )
+            def resize_keyframe(frame):
+                default_size_frame = cv2.resize(frame, default_size)
+                return cv2.resize(default_size_frame, None, fx=keyframe_ratio, fy=keyframe_ratio)
 
-                if do_clip:
-                    video_frame_center = len(video_frames) - video_length + 1
-                    video_start_frame = max(0, video_frame_center - video_clip_interval * 3)
-                    video_end_frame = min(
-                        len(video_frames) - 1, video_start_frame + video_clip_interval * 7
+        else:
+            # Piped frames are already scaled to the keyframe size
+            def resize_keyframe(frame):
+                return frame
+
+        if not do_clip:
+            with self._open_keyframe_saver(video_path, f"{start:06d}") as save_keyframe:
+                for frame_id, frame in frame_reader(frame_ids):
+                    if frame_id in scene_starts_set:
+                        update_progress(advance=1)
+
+                    keyframe = resize_keyframe(frame)
+                    if not keep_keyframe(frame_id, keyframe):
+                        continue
+
+                    save_keyframe(frame_id, keyframe)
+            return [], duplicates, frame_hashes
+
+        # Keyframes are emitted video_length - 1 frames late so that the frames after them are available for clips
+        buffer_capacity = video_length + video_clip_interval * 3
+
+        # Decoding starts at an I-frame early enough to hold the clip of the first keyframe of the chunk
+        i = bisect_right(keyframes_list, max(0, start + 1 - video_clip_interval * 3))
+        decode_start = keyframes_list[i - 1] if i > 0 and start > 0 else 0
+
+        frame_buffer = None
+        resize_on_push = False
+
+        def get_frame(frame_index):
+            assert frame_buffer is not None
+            buffered_frame = frame_buffer.get(frame_index)
+            return buffered_frame if resize_on_push else resize_keyframe(buffered_frame)
+
+        clip_frame_ids = []
+        next_frame_id = next(frame_ids, None)
+        clip_writer = (
+            ClipWriter(video_clips_dir, f"{start:06d}", clip_frame_size) if clip_format == "packed" else None
+        )
+        with clip_writer or nullcontext(), self._open_keyframe_saver(video_path, f"{start:06d}") as save_keyframe:
+            for frame_counter, frame in frame_reader(count(decode_start)):
+                if frame_buffer is None:
+                    frame_buffer, resize_on_push = self._create_frame_buffer(
+                        frame, resize_keyframe(frame), buffer_capacity, max_buffer_memory, decode_start
                     )
 
+                frame_buffer.push(resize_keyframe(frame) if resize_on_push else frame)
+
+                video_frame_counter = frame_counter - video_length + 1
+
+                if end is not None and video_frame_counter >= end:
+                    break
+                if video_frame_counter < start:
+                    continue
+
+                if video_frame_counter in scene_starts_set:
+                    update_progress(advance=1)
+
+                if video_frame_counter != next_frame_id:
+                    continue
+                next_frame_id = next(frame_ids, None)
+
+                current_frame = get_frame(video_frame_counter)
+                if not keep_keyframe(video_frame_counter, current_frame):
+                    continue
+
+                save_keyframe(video_frame_counter, current_frame)
+
+                # Clip frames are the keyframe and the frames of a grid shared by the whole video, so that
+                # overlapping clips and keyframes share frames whose embeddings are computed once by analyse
+                grid_index = video_frame_counter // video_clip_interval
+                video_clip_ids = [
+                    j * video_clip_interval
+                    for j in range(grid_index - 2, grid_index + 5)
+                    if frame_buffer.first_index <= j * video_clip_interval <= frame_buffer.last_index
+                ]
+                video_clip_ids = sorted(set(video_clip_ids + [video_frame_counter]))
+                if clip_writer is not None:
+                    for i in video_clip_ids:
+                        if i not in clip_writer:
+                            clip_writer.write_frame(i, get_frame(i))
+                    clip_writer.write_clip(video_frame_counter, video_clip_ids)
+                else:
                     video_writer = cv2.VideoWriter(
                         str(video_clips_dir / f"{video_frame_counter:06d}.mp4"),
                         cv2.VideoWriter_fourcc(*"mp4v"),
                         video_clip_fps,
                         current_frame.shape[:2][::-1],
                     )
-                    for i in range(video_start_frame, video_end_frame + 1, video_clip_interval):
-                        video_writer.write(video_frames[i])
+                    for i in video_clip_ids:
+                        video_writer.write(get_frame(i))
                     video_writer.release()
 
-                    if do_audio:
-                        assert video_frame_counter is not None
-                        assert audio_fps is not None
-                        assert audio_clip_interval is not None
-                        assert audio_frames is not None
-                        assert audio_frame_size is not None
-                        assert wave_params is not None
-
-                        audio_frame_counter = round(video_frame_counter / video_fps * audio_fps)
-                        audio_start_frame = max(0, audio_frame_counter - audio_clip_interval * 3)
-                        audio_end_frame = min(
-                            len(audio_frames) - 1, audio_start_frame + audio_clip_interval * 7
-                        )
+                clip_frame_ids.append(video_frame_counter)
 
-                        with wave.open(
-                            str(audio_clips_dir / f"{video_frame_counter:06d}.wav"), "wb"
-                        ) as f:
-                            f.setparams(wave_params)
-                            f.writeframes(
-                                audio_frames[
-                                    audio_start_frame
-                                    * audio_frame_size : audio_end_frame
-                                    * audio_frame_size
-                                    + 1
-                                ]
-                            )
-
-                scene_length = 0
-
-            if video_frame_counter >= 0:
-                scene_length += 1
-            _frame_counter += 1
-        cap.release()
-
-    def _get_keyframes_list(self, video_path: Path):
-        ffprobe_cmd = (
-            ["ffprobe", "-v", "quiet"]
-            + [
-                "-select_streams",
-                "v",
-                "-show_frames",
-                "-show_entries",
-                "frame=pict_type",
-            ]
-            + ["-of", "csv", str(video_path)]
-        )
-        res = subprocess.run(ffprobe_cmd, capture_output=True, text=True)
-        keyframes_list = res.stdout.strip().split("\n")
-        keyframes_list = [x for x in keyframes_list if x.startswith("frame")]
-        keyframes_list = [i for i, x in enumerate(keyframes_list) if x.startswith("frame,I")]
-        return keyframes_list
-
-    def _extract_video_info(self, video_path: Path):
-        info_file = self._work_dir / constant.VIDEO_INFO_DIR / f"{video_path.stem}.json"
-        info_file.parent.mkdir(parents=True, exist_ok=True)
-
-        data = {constant.FPS_KEY: self._get_fps(video_path)}
-        with open(info_file, "w") as f:
-            json.dump(data, f)
-
-    def _get_fps(self, video_path: Path):
-        ffprobe_cmd = ["ffprobe", "-v", "quiet", "-of", "compact=p=0"] + [
-            "-select_streams",
-            "0",
-            "-show_entries",
-            "stream=r_frame_rate",
-            str(video_path),
-        ]
-        res = subprocess.run(ffprobe_cmd, capture_output=True, text=True)
+        return clip_frame_ids, duplicates, frame_hashes
+
+    def _remove_keyframes(self, video_path: Path, frame_ids: set[int], do_clip: bool):
+        keyframe_dir = self._work_dir / constant.KEYFRAME_DIR / f"{video_path.stem}"
+        thumbnail_dir = self._work_dir / constant.THUMBNAIL_DIR / f"{video_path.stem}"
+        video_clips_dir = self._work_dir / constant.VIDEO_CLIP_DIR / f"{video_path.stem}"
 
-        fraction = str(res.stdout).split("=")[1].split("/")
-        fps = round(int(fraction[0]) / int(fraction[1]))
+        remove_images(keyframe_dir, frame_ids)
+        remove_images(thumbnail_dir, frame_ids)
+        # Packed clips of removed keyframes are dropped when the clip stores are merged
+        if do_clip and (GlobalConfig.get("add", "clip_format") or "packed") == "mp4":
+            for frame_id in frame_ids:
+                (video_clips_dir / f"{frame_id:06d}.mp4").unlink(missing_ok=True)
 
-        return fps
+    def _save_duplicates(self, video_path: Path, duplicates: dict[int, int]):
+        # Dropped frames are mapped to the kept frame representing them
+        if len(duplicates) > 0:
+            save_duplicates(self._work_dir / constant.DUPLICATE_DIR / f"{video_path.stem}.json", duplicates)
 
-    def _extract_audio(self, video_path: Path, do_overwrite: bool, update_progress: Callable):
+    def _extract_audio_clips(self, video_path: Path, frame_ids: list[int], video_fps: int):
         audio_path = self._work_dir / constant.AUDIO_DIR / f"{video_path.stem}.wav"
+        audio_clips_path = self._work_dir / constant.AUDIO_CLIP_DIR / f"{video_path.stem}.json"
+
+        clip_length = GlobalConfig.get("add", "clip_length") or 7  # in seconds
+
+        # Only the header is read, clips are sample ranges of the WAV read on demand with AudioClipStore
+        with wave.open(str(audio_path), "rb") as f:
+            audio_fps = f.getframerate()
+            audio_num_frames = f.getnframes()
+
+        audio_length = clip_length * audio_fps  # in frames
+        audio_clip_interval = audio_length // 7
 
-        if audio_path.exists() and not do_overwrite:
-            return
+        audio_clips = {}
+        for frame_id in frame_ids:
+            audio_frame_counter = round(frame_id / video_fps * audio_fps)
+            audio_start_frame = max(0, audio_frame_counter - audio_clip_interval * 3)
+            audio_end_frame = min(audio_num_frames, audio_start_frame + audio_clip_interval * 7)
+            audio_clips[frame_id] = (audio_start_frame, audio_end_frame)
+
+        save_audio_clips(audio_clips_path, audio_fps, audio_clips)
+
+    @contextmanager
+    def _open_keyframe_saver(self, video_path: Path, name: str):
+        keyframe_dir = self._work_dir / constant.KEYFRAME_DIR / f"{video_path.stem}"
+        thumbnail_dir = self._work_dir / constant.THUMBNAIL_DIR / f"{video_path.stem}"
+
+        thumbnail_ratio = GlobalConfig.get("add", "thumbnail_resize_ratio") or 0.25
+        image_format = GlobalConfig.get("add", "image_format") or "jpg"
+        image_writer_workers = GlobalConfig.get("add", "image_writer_workers") or 2
+        image_writer_pending = GlobalConfig.get("add", "image_writer_pending") or 32
+
+        # The image writer is flushed before the stores are closed
+        with (
+            create_image_store_writer(keyframe_dir, image_format, name) as keyframe_store,
+            create_image_store_writer(thumbnail_dir, image_format, name) as thumbnail_store,
+            ImageWriter(image_writer_workers, image_writer_pending) as image_writer,
+        ):
+
+            def save_keyframe(frame_id: int, keyframe: np.ndarray):
+                image_writer.write(keyframe_store, frame_id, keyframe)
+
+                thumbnail = cv2.resize(keyframe, None, fx=thumbnail_ratio, fy=thumbnail_ratio)
+                image_writer.write(thumbnail_store, frame_id, thumbnail)
+
+            yield save_keyframe
+
+    def _build_storyboard(self, video_id: str, update_progress: Callable):
+        update_progress(description=f"Building storyboard", completed=0, total=1)
+
+        thumbnail_dir = self._work_dir / constant.THUMBNAIL_DIR / video_id
+        storyboard_dir = self._work_dir / constant.STORYBOARD_DIR / video_id
+
+        tile_width = GlobalConfig.get("add", "storyboard_tile_width") or 160
+        columns = GlobalConfig.get("add", "storyboard_columns") or 10
+        rows = GlobalConfig.get("add", "storyboard_rows") or 10
+
+        save_storyboard(storyboard_dir, open_image_store(thumbnail_dir), tile_width, columns, rows)
+
+        update_progress(advance=1)
+
+    def _create_frame_buffer(
+        self, raw_frame: np.ndarray, keyframe: np.ndarray, capacity: int, max_buffer_memory: float, start_index: int
+    ):
+        max_nbytes = max_buffer_memory * 1024 * 1024
+
+        # Prefer decoded frames so that only emitted frames get resized
+        if FrameRingBuffer.estimate_nbytes(capacity, raw_frame.shape) <= max_nbytes:
+            return FrameRingBuffer(capacity, raw_frame.shape, start_index=start_index), False
+
+        if FrameRingBuffer.estimate_nbytes(capacity, keyframe.shape) <= max_nbytes:
+            return FrameRingBuffer(capacity, keyframe.shape, start_index=start_index), True
+
+        raise RuntimeError(
+            f"Frame buffer of {capacity} frames exceeds frame_buffer_memory={max_buffer_memory}MB. "
+            "Reduce clip_length or keyframe_resize_ratio, or increase frame_buffer_memory."
+        )
+
+    def _get_media_info(self, video_path: Path, source_path: Path | None = None):
+        info_path = self._work_dir / constant.VIDEO_INFO_DIR / f"{video_path.stem}.json"
+        return load_media_info(info_path, video_path, source_path)
+
+    def _extract_audio(self, video_path: Path, update_progress: Callable):
+        audio_path = self._work_dir / constant.AUDIO_DIR / f"{video_path.stem}.wav"
 
         audio_path.parent.mkdir(parents=True, exist_ok=True)
 
         update_progress(description="Extracting audio", completed=0, total=1)
-        # ffmpeg -i test.mp4 -ab 160k -ac 2 -ar 44100 -vn audio.wa
-        ffmpeg_cmd = (
-            ["ffmpeg", "-v", "quiet", "-y"]
-            + ["-i", str(video_path)]
-            + ["-ab", "160k", "-ac", "1", "-ar", "11000", "-vn", str(audio_path)]
-        )
+        ffmpeg_cmd = ["ffmpeg", "-v", "quiet", "-y"] + ["-i", str(video_path)] + self._audio_args(audio_path)
         subprocess.run(ffmpeg_cmd)
 
         update_progress(advance=1)
 
+    def _audio_args(self, audio_path: Path):
+        # ffmpeg -i test.mp4 -ab 160k -ac 2 -ar 44100 -vn audio.wa
+        return ["-ab", "160k", "-ac", "1", "-ar", "11000", "-vn", str(audio_path)]
+
     def _compress_video(self, video_id: str, update_progress: Callable):
         video_path = self._work_dir / constant.VIDEO_DIR / f"{video_id}.mp4"
-        video_path = video_path.rename(video_path.parent / f"_{video_path.stem}.mp4")
+        raw_video_path = video_path.parent / f"_{video_path.stem}.mp4"
+
+        # The renamed video is left by an interrupted compression, the output is then incomplete
+        if raw_video_path.exists():
+            media_info = self._get_media_info(raw_video_path)
+        else:
+            media_info = self._get_media_info(video_path)
+            video_path.rename(raw_video_path)
+        video_path = raw_video_path
 
         output_path = self._work_dir / constant.VIDEO_DIR / f"{video_id}.mp4"
-        compress_size_rate = GlobalConfig.get("add", "compress_size_rate") or 0.5
 
         update_progress(description="Compress video", completed=0, total=1)
-        # ffmpeg -i input.mp4 -vf scale="iw:ih" -c:v libx264 -tune zerolatency -preset ultrafast -crf 40 -c:a aac -b:a 32k  output.mp4 -y
-        default_size = GlobalConfig.get("add", "default_size") or [1280, 720]
-        ffmpeg_cmd = (
-            ["ffmpeg", "-v", "quiet", "-y"]
-            + ["-i", str(video_path)]
-            + [
-                "-vf",
-                f"scale={default_size[0]}*{compress_size_rate}:{default_size[1]}*{compress_size_rate}",
-            ]
-            + [
-                "-c:v",
-                "libx264",
-                "-crf",
-                "28",
-                "-preset",
-                "medium",
-                "-c:a",
-                "aac",
-                "-b:a",
-                "32k",
-                str(output_path),
-            ]
-        )
+        ffmpeg_cmd = ["ffmpeg", "-v", "quiet", "-y"] + ["-i", str(video_path)] + self._compress_args(output_path)
         subprocess.run(ffmpeg_cmd)
 
         os.remove(video_path)
 
+        # Scenes are still selected from the I-frames of the original encoding, seeks use the ones of the output
+        info_path = self._work_dir / constant.VIDEO_INFO_DIR / f"{video_id}.json"
+        source_keyframes = media_info[constant.SOURCE_KEYFRAMES_KEY]
+        save_media_info(info_path, probe_media_info(output_path, source_keyframes=source_keyframes))
+
+        update_progress(advance=1)
+
+    def _compress_args(self, output_path: Path):
+        compress_size_rate = GlobalConfig.get("add", "compress_size_rate") or 0.5
+        default_size = GlobalConfig.get("add", "default_size") or [1280, 720]
+
+        # ffmpeg -i input.mp4 -vf scale="iw:ih" -c:v libx264 -tune zerolatency -preset ultrafast -crf 40 -c:a aac -b:a 32k  output.mp4 -y
+        return [
+            "-vf",
+            f"scale={default_size[0]}*{compress_size_rate}:{default_size[1]}*{compress_size_rate}",
+        ] + [
+            "-c:v",
+            "libx264",
+            "-crf",
+            "28",
+            "-preset",
+            "medium",
+            "-c:a",
+            "aac",
+            "-b:a",
+            "32k",
+            str(output_path),
+        ]
+
+    def _get_keyframe_size(self):
+        default_size = GlobalConfig.get("add", "default_size") or [1280, 720]
+        keyframe_ratio = GlobalConfig.get("add", "keyframe_resize_ratio") or 0.5
+        return round(default_size[0] * keyframe_ratio), round(default_size[1] * keyframe_ratio)
+
+    def _ingest_video(
+        self,
+        video_path: Path,
+        do_move: bool,
+        do_audio: bool,
+        do_clip: bool,
+        stages: set[str],
+        update_progress: Callable,
+    ):
+        video_id = video_path.stem
+        output_path = self._work_dir / constant.VIDEO_DIR / f"{video_id}{video_path.suffix}"
+        audio_path = self._work_dir / constant.AUDIO_DIR / f"{video_id}.wav"
+        info_path = self._work_dir / constant.VIDEO_INFO_DIR / f"{video_id}.json"
+
+        # Only the outputs of the given stages are written
+        do_save = "load" in stages
+        do_compress = "compress" in stages
+        do_audio_output = "audio" in stages
+        do_frames = "keyframes" in stages
+        if do_frames:
+            self._prepare_keyframe_dirs(output_path, do_audio, do_clip)
+
+        update_progress(description=f"Saving video", completed=0, total=1)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Keyframes are probed from the packets of the original encoding before it is compressed or moved
+        if do_save:
+            media_info = probe_media_info(video_path)
+            if do_compress:
+                input_path = video_path
+            else:
+                if do_move:
+                    shutil.move(video_path, output_path)
+                else:
+                    shutil.copy(video_path, output_path)
+                input_path = output_path
+        else:
+            media_info = self._get_media_info(output_path)
+            input_path = output_path
+
         update_progress(advance=1)
+
+        output_args = []
+        if do_compress:
+            output_args += self._compress_args(output_path)
+        if do_audio_output and probe_has_audio(input_path):
+            audio_path.parent.mkdir(parents=True, exist_ok=True)
+            output_args += self._audio_args(audio_path)
+
+        keyframes_list = media_info[constant.KEYFRAMES_KEY]
+        video_fps = media_info[constant.FPS_KEY]
+        frame_size = self._get_keyframe_size() if do_frames else None
+
+        # Content-based selectors decode the video on their own before the pass
+        scene_starts = self._select_scene_starts(input_path, media_info) if do_frames else []
+
+        clip_frame_ids = []
+        duplicates = {}
+        if len(output_args) > 0 or frame_size is not None:
+            update_progress(description=f"Ingesting video", completed=0, total=len(scene_starts))
+            with FFmpegIngest(input_path, output_args, frame_size) as ingest:
+                if do_frames:
+                    clip_frame_ids, duplicates, _ = self._extract_keyframes_chunk(
+                        output_path,
+                        keyframes_list,
+                        scene_starts,
+                        video_fps,
+                        do_clip,
+                        0,
+                        None,
+                        update_progress,
+                        ingest.read_frames,
+                    )
+
+        if do_compress and do_move:
+            os.remove(video_path)
+        if do_save:
+            source_keyframes = media_info[constant.SOURCE_KEYFRAMES_KEY]
+            save_media_info(info_path, probe_media_info(output_path, source_keyframes=source_keyframes))
+
+        if do_frames:
+            self._save_duplicates(output_path, duplicates)
+        if do_frames and do_clip and do_audio:
+            self._extract_audio_clips(output_path, clip_frame_ids, video_fps)
@@ -1,11 +1,15 @@
+from itertools import groupby
+
 import numpy as np
 import torch
 from rich.progress import Progress, SpinnerColumn, TextColumn, TimeElapsedColumn
 
 import aic51.packages.constant as constant
-from aic51.packages.analyse import FeatureExtractor, FeatureExtractorFactory
+from aic51.packages.analyse import AnalyseProcessor, FeatureExtractor, FeatureExtractorFactory, FrameEmbeddingCache
 from aic51.packages.config import GlobalConfig
 from aic51.packages.logger import logger
+from aic51.packages.media import ClipStore, open_image_store
+from aic51.packages.utils import FeatureStore, FeatureStoreWriter, remove_feature_store
 
 from .command import BaseCommand
 
@@ -44,11 +48,19 @@ class AnalyseCommand(BaseCommand):
 
         logger.info(f"Starting analyse process with (device={device})")
 
+        # Video features encode the frames shared by overlapping packed clips once
+        frame_cache_size = GlobalConfig.get("analyse", "frame_cache_size")
+        frame_cache_size = 65536 if frame_cache_size is None else frame_cache_size
+        frame_cache = FrameEmbeddingCache(frame_cache_size) if frame_cache_size > 0 else None
+
+        feature_extractors = []
+        num_workers = {}
         for feature_name in feature_infos.keys():
             source = GlobalConfig.get("features", feature_name, "source")
             model_name = GlobalConfig.get("features", feature_name, "model")
             arch_name = GlobalConfig.get("features", feature_name, "arch_name")
             pretrained_model = GlobalConfig.get("features", feature_name, "pretrained_model")
+            runtime = GlobalConfig.get("features", feature_name, "runtime") or "torch"
             batch_size = GlobalConfig.get("features", feature_name, "analyse", "batch_size") or 1
 
             assert model_name is not None
@@ -62,6 +74,8 @@ class AnalyseCommand(BaseCommand):
                     name=feature_name,
                     batch_size=batch_size,
                     device=device,
+                    runtime=runtime,
+                    frame_cache=frame_cache,
                 )
             else:
                 feature_extractor = None
@@ -73,6 +87,22 @@ class AnalyseCommand(BaseCommand):
                 logger.error(f"{polite_name}: invalid feature extractor")
                 continue
 
+            feature_extractors.append(feature_extractor)
+            num_workers[feature_name] = GlobalConfig.get("features", feature_name, "analyse", "num_workers")
+
+        decode_chunk_size = GlobalConfig.get("analyse", "decode_chunk_size") or 256
+        decode_workers = GlobalConfig.get("analyse", "decode_workers") or 4
+        max_pending_chunks = GlobalConfig.get("analyse", "max_pending_chunks") or 2
+        processor = AnalyseProcessor(
+            feature_extractors, decode_chunk_size, decode_workers, num_workers, max_pending_chunks
+        )
+
+        # Intra-op threads are a process-wide torch setting, every model extractor shares them
+        torch_threads = GlobalConfig.get("analyse", "torch_threads")
+        if torch_threads:
+            torch.set_num_threads(torch_threads)
+
+        try:
             with (
                 Progress(
                     TextColumn("{task.fields[name]}"),
@@ -83,8 +113,14 @@ class AnalyseCommand(BaseCommand):
                     disable=not verbose,
                 ) as progress,
             ):
-                for video_id in video_ids:
-                    self._analyse_one_video(feature_extractor, video_id, progress, do_overwrite)
+                self._analyse_videos(processor, video_ids, progress, do_overwrite)
+        finally:
+            for feature_extractor in feature_extractors:
+                feature_extractor.close()
+
+        processor.log_throughput()
+        if frame_cache is not None:
+            logger.info(f"analyse: frame embeddings reused for {frame_cache.get_hit_rate():.1%} of the frames")
 
     def _get_device(self, do_gpu: bool):
         device = torch.device("cpu")
@@ -108,75 +144,101 @@ class AnalyseCommand(BaseCommand):
         features_dir = self._work_dir / constant.FEATURE_DIR / video_id
 
         has_features = set()
-        if features_dir.exists() and not do_overwrite:
-            for feature_path in features_dir.glob("*/*.npy"):
-                if feature_path.is_dir():
-                    continue
-
-                if feature_path.stem == feature_extractor.name:
-                    has_features.add(feature_path.parent.stem)
+        if FeatureStore.exists(features_dir, feature_extractor.name) and not do_overwrite:
+            has_features = set(FeatureStore(features_dir, feature_extractor.name).keys())
 
+        # Keyframes are integer ids so that they keep the frame order past 6 digits
         keyframes = []
-        for keyframe in keyframes_dir.glob("*"):
-            if keyframe.is_dir() or keyframe.stem[0] == "." or keyframe.stem in has_features:
+        for frame_id in open_image_store(keyframes_dir).keys():
+            if frame_id in has_features:
                 continue
-            keyframes.append(keyframe.stem)
+            keyframes.append(frame_id)
 
         keyframes = sorted(keyframes)
 
         return keyframes
 
-    def _get_input_files(self, feature_extractor: FeatureExtractor, video_id: str, keyframes: list[str]):
+    def _get_input_files(self, feature_extractor: FeatureExtractor, video_id: str, keyframes: list[int]):
+        # Returns the keyframes having an input and their inputs
         inputs_dir = self._work_dir / feature_extractor.require_input() / video_id
         if not inputs_dir.exists():
             raise RuntimeError(
                 f'video_id={video_id} does not have "{feature_extractor.require_input()}" for {feature_extractor.name}'
             )
 
+        # Packed clips are read from memory-mapped views of the clip store
+        if ClipStore.exists(inputs_dir):
+            clip_store = ClipStore(inputs_dir)
+            keyframes = [k for k in keyframes if k in clip_store]
+            return keyframes, [clip_store.get_clip(k) for k in keyframes]
+
+        # Keyframes are read either as files or as memory-mapped views of a packed image store
+        if feature_extractor.require_input() == constant.KEYFRAME_DIR:
+            image_store = open_image_store(inputs_dir)
+            keyframes = [k for k in keyframes if k in image_store]
+            return keyframes, [image_store.get(k) for k in keyframes]
+
         keyframes_set = set(keyframes)
+        input_files = sorted(
+            [f for f in inputs_dir.glob("*") if f.stem.isdigit() and int(f.stem) in keyframes_set],
+            key=lambda x: int(x.stem),
+        )
 
-        return sorted([f for f in inputs_dir.glob("*") if f.stem in keyframes_set], key=lambda x: x.stem)
+        return [int(f.stem) for f in input_files], input_files
 
-    def _analyse_one_video(
-        self, feature_extractor: FeatureExtractor, video_id: str, progress: Progress, do_overwrite: bool
+    def _analyse_videos(
+        self, processor: AnalyseProcessor, video_ids: list[str], progress: Progress, do_overwrite: bool
     ):
         task_id = progress.add_task(
             description="Analysing",
-            name=video_id,
+            name=f"{len(video_ids)} videos",
         )
-        try:
-            progress.update(
-                task_id,
-                description="Extracting features",
-            )
-
-            keyframes = self._get_keyframes_list(feature_extractor, video_id, do_overwrite)
-            input_files = self._get_input_files(feature_extractor, video_id, keyframes)
 
-            def update_progress(feature_extractor, completed, total, res):
-                progress.update(task_id, completed=completed, total=total)
+        # Inputs of every video are processed as one stream so that batches are full across videos, keys are
+        # (video_id, keyframe) and each extractor gets the keyframes it misses
+        inputs = {feature_extractor.name: ([], []) for feature_extractor in processor.extractors}
+        for video_id in video_ids:
+            if do_overwrite:
+                for feature_extractor in processor.extractors:
+                    remove_feature_store(self._work_dir / constant.FEATURE_DIR / video_id, feature_extractor.name)
 
-            features = feature_extractor.get_features(input_files, update_progress)
+            for feature_extractor in processor.extractors:
+                keyframes = self._get_keyframes_list(feature_extractor, video_id, do_overwrite)
+                keyframes, input_files = self._get_input_files(feature_extractor, video_id, keyframes)
+                inputs[feature_extractor.name][0].extend((video_id, keyframe) for keyframe in keyframes)
+                inputs[feature_extractor.name][1].extend(input_files)
 
-            progress.update(
-                task_id,
-                description="Saving features",
-                name=video_id,
-                total=len(keyframes),
-            )
+        progress.update(task_id, description="Extracting features")
 
-            video_save_dir = self._work_dir / constant.FEATURE_DIR / video_id
-            for i, keyframe in enumerate(keyframes):
-                keyframe_save_dir = video_save_dir / keyframe
-                keyframe_save_dir.mkdir(parents=True, exist_ok=True)
-                feature = np.array(features[i])
+        def update_progress(processor, completed, total):
+            progress.update(task_id, completed=completed, total=total)
 
-                assert isinstance(feature, np.ndarray)
+        # Batches of an extractor come in key order, so only the store of the video being saved is kept open
+        feature_writers = {}
 
-                np.save(keyframe_save_dir / f"{feature_extractor.name}.npy", feature)
-                progress.update(task_id, advance=1)
+        def save_features(feature_extractor, keys, batch_features):
+            batch_features = np.asarray(batch_features)
+            for video_id, group in groupby(range(len(keys)), key=lambda i: keys[i][0]):
+                rows = list(group)
+                writer = self._get_feature_writer(feature_writers, feature_extractor.name, video_id)
+                writer.write([keys[i][1] for i in rows], batch_features[rows])
 
-            progress.remove_task(task_id)
-        except Exception as e:
-            raise e
-            progress.update(task_id, description=f"Error: {str(e)}")
+        # Features are saved batch by batch so that an interrupted analyse resumes from its last saved batch
+        try:
+            processor.process(inputs, update_progress, save_features)
+        finally:
+            for _, writer in feature_writers.values():
+                writer.close()
+
+        progress.remove_task(task_id)
+
+    def _get_feature_writer(self, feature_writers: dict, feature_name: str, video_id: str):
+        if feature_name in feature_writers:
+            writer_video_id, writer = feature_writers[feature_name]
+            if writer_video_id == video_id:
+                return writer
+            writer.close()
+
+        writer = FeatureStoreWriter(self._work_dir / constant.FEATURE_DIR / video_id, feature_name).open()
+        feature_writers[feature_name] = (video_id, writer)
+        return writer
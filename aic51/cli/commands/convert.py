@@ -0,0 +1,113 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+from rich.progress import Progress, SpinnerColumn, TextColumn, TimeElapsedColumn
+
+import aic51.packages.constant as constant
+from aic51.packages.config import GlobalConfig
+from aic51.packages.logger import logger
+from aic51.packages.utils import FeatureStore, FeatureStoreWriter
+
+from .command import BaseCommand
+
+
+class ConvertCommand(BaseCommand):
+    BATCH_SIZE = 1024
+
+    def __init__(self, *args, **kwargs):
+        super(ConvertCommand, self).__init__(*args, **kwargs)
+
+    def add_args(self, subparser):
+        parser = subparser.add_parser("convert", help="Convert per-frame feature files to feature stores")
+
+        parser.add_argument(
+            "--remove",
+            dest="do_remove",
+            action="store_true",
+            help="Remove per-frame feature files once converted",
+        )
+
+        parser.set_defaults(func=self)
+
+    def __call__(self, do_remove: bool, verbose: bool, *args, **kwargs):
+        features_dir = self._work_dir / constant.FEATURE_DIR
+
+        video_ids = sorted([f.stem for f in features_dir.glob("*") if f.is_dir()])
+
+        max_workers_ratio = GlobalConfig.get("max_workers_ratio") or 0
+        max_workers = max(1, int(max_workers_ratio * (os.cpu_count() or 0)))
+        with (
+            Progress(
+                TextColumn("{task.fields[name]}"),
+                TextColumn(":"),
+                SpinnerColumn(),
+                *Progress.get_default_columns(),
+                TimeElapsedColumn(),
+                disable=not verbose,
+            ) as progress,
+            ThreadPoolExecutor(max_workers) as executor,
+        ):
+
+            def show_progress(task_id):
+                return lambda **kwargs: progress.update(task_id, **kwargs)
+
+            def convert_one_video(video_id: str):
+                task_id = progress.add_task(
+                    description=f"Processing...",
+                    name=video_id,
+                )
+                try:
+                    self._convert_one_video(video_id, do_remove, show_progress(task_id))
+                    progress.remove_task(task_id)
+                except Exception as e:
+                    logger.exception(e)
+                    progress.update(
+                        task_id,
+                        description=f"Error: {str(e)}",
+                    )
+
+            futures = []
+            for video_id in video_ids:
+                futures.append(executor.submit(convert_one_video, video_id))
+            for f in futures:
+                f.result()
+
+    def _convert_one_video(self, video_id: str, do_remove: bool, update_progress: Callable):
+        video_features_dir = self._work_dir / constant.FEATURE_DIR / video_id
+
+        frame_dirs = sorted(
+            [d for d in video_features_dir.glob("*") if d.is_dir() and d.stem.isdigit()],
+            key=lambda d: int(d.stem),
+        )
+
+        feature_paths = {}
+        for frame_dir in frame_dirs:
+            for feature_path in frame_dir.glob("*.npy"):
+                feature_paths.setdefault(feature_path.stem, []).append((int(frame_dir.stem), feature_path))
+
+        update_progress(
+            description=f"Converting",
+            completed=0,
+            total=sum(len(paths) for paths in feature_paths.values()),
+        )
+
+        for feature_name, paths in feature_paths.items():
+            # Frames already in the store are the ones of an interrupted conversion or of a newer analyse
+            converted = set()
+            if FeatureStore.exists(video_features_dir, feature_name):
+                converted = set(FeatureStore(video_features_dir, feature_name).keys())
+
+            with FeatureStoreWriter(video_features_dir, feature_name) as writer:
+                for i in range(0, len(paths), self.BATCH_SIZE):
+                    batch = [(k, path) for k, path in paths[i : i + self.BATCH_SIZE] if k not in converted]
+                    if len(batch) > 0:
+                        writer.write([frame_id for frame_id, _ in batch], [np.load(path) for _, path in batch])
+
+                    update_progress(advance=min(self.BATCH_SIZE, len(paths) - i))
+
+        if do_remove:
+            for frame_dir in frame_dirs:
+                shutil.rmtree(frame_dir)
@@ -0,0 +1,157 @@
+import numpy as np
+import torch
+from PIL import Image
+
+import aic51.packages.constant as constant
+from aic51.packages.analyse import FeatureExtractorFactory
+from aic51.packages.analyse.features.runtime import (
+    EXPORT_RUNTIMES,
+    ExportedEncoder,
+    check_parity,
+    export_encoder,
+    get_export_dir,
+    get_export_path,
+)
+from aic51.packages.config import GlobalConfig
+from aic51.packages.logger import logger
+from aic51.packages.media import ClipStore, open_image, open_image_store
+
+from .command import BaseCommand
+
+
+class ExportCommand(BaseCommand):
+    EXPORTABLE_MODELS = ["image_clip", "video_clip"]
+
+    def __init__(self, *args, **kwargs):
+        super(ExportCommand, self).__init__(*args, **kwargs)
+
+    def add_args(self, subparser):
+        parser = subparser.add_parser("export", help="Export image and text encoders for CPU inference")
+
+        parser.add_argument(
+            "--runtime",
+            dest="runtime",
+            choices=list(EXPORT_RUNTIMES.keys()),
+            default="onnx",
+            help="Runtime to export the encoders to",
+        )
+        parser.add_argument(
+            "--int8",
+            dest="do_quantize",
+            action="store_true",
+            help="Quantize the weights of linear layers to int8",
+        )
+        parser.add_argument(
+            "--min-similarity",
+            dest="min_similarity",
+            type=float,
+            default=0.99,
+            help="Minimum cosine similarity between eager and exported embeddings",
+        )
+        parser.add_argument(
+            "--num-samples",
+            dest="num_samples",
+            type=int,
+            default=32,
+            help="Keyframes and clip frames of the workspace the exported image encoders are checked on",
+        )
+
+        parser.set_defaults(func=self)
+
+    def __call__(self, runtime: str, do_quantize: bool, min_similarity: float, num_samples: int, *args, **kwargs):
+        models = self._get_models()
+        if len(models) == 0:
+            raise RuntimeError(f"No exportable models ({', '.join(self.EXPORTABLE_MODELS)}). Check your config file.")
+
+        # Image encoders are checked on frames of the workspace, random images are only used without any
+        sample_images = self._get_sample_images(num_samples)
+        if sample_images is None:
+            logger.warning("No keyframes or clips in the workspace, exported image encoders are checked on noise")
+
+        failed = []
+        for (source, arch_name, pretrained_model), (model_name, name) in models.items():
+            polite_name = f"{model_name}" + (f' from "{pretrained_model}"' if pretrained_model else "")
+            logger.info(f"Exporting {polite_name} to {runtime}" + (" with int8 weights" if do_quantize else ""))
+
+            feature_extractor_cls = FeatureExtractorFactory.get(model_name)
+            feature_extractor = feature_extractor_cls.from_pretrained(
+                source=source,
+                arch_name=arch_name,
+                pretrained_model=pretrained_model,
+                name=name,
+                device=torch.device("cpu"),
+            )
+
+            export_dir = get_export_dir(source, arch_name, pretrained_model)
+            try:
+                for encoder_name, (module, example_inputs) in feature_extractor.get_encoders(sample_images).items():
+                    export_path = get_export_path(export_dir, encoder_name, runtime)
+                    export_encoder(module, example_inputs, export_path, runtime, do_quantize)
+
+                    mean_similarity, similarity = check_parity(
+                        module, ExportedEncoder(export_path, runtime), example_inputs
+                    )
+                    logger.info(f"{polite_name}: {encoder_name} encoder exported to {export_path}")
+                    logger.info(
+                        f"{polite_name}: {encoder_name} encoder cosine similarity to eager over "
+                        f"{len(example_inputs[0])} inputs: mean {mean_similarity:.4f}, min {similarity:.4f}"
+                    )
+                    if similarity < min_similarity:
+                        failed.append(f"{polite_name} ({encoder_name}: {similarity:.4f})")
+            finally:
+                feature_extractor.close()
+
+        if len(failed) > 0:
+            raise RuntimeError(
+                f"Exported encoders differ from the eager ones (min similarity {min_similarity}): {', '.join(failed)}"
+            )
+
+    def _get_sample_images(self, num_samples: int) -> list[Image.Image] | None:
+        # Keyframes and frames of packed clips evenly spread over the videos of the workspace
+        keyframes_dir = self._work_dir / constant.KEYFRAME_DIR
+        clips_dir = self._work_dir / constant.VIDEO_CLIP_DIR
+
+        keyframes = []
+        for video_dir in sorted(d for d in keyframes_dir.glob("*") if d.is_dir() and d.stem[0] != "."):
+            image_store = open_image_store(video_dir)
+            keyframes += [(image_store, frame_id) for frame_id in image_store.keys()]
+
+        clip_frames = []
+        for video_dir in sorted(d for d in clips_dir.glob("*") if d.is_dir() and d.stem[0] != "."):
+            if ClipStore.exists(video_dir):
+                clip_store = ClipStore(video_dir)
+                clip_frames += [(clip_store, frame_id) for frame_id in clip_store.keys()]
+
+        num_clip_frames = min(len(clip_frames), num_samples // 2)
+        num_keyframes = min(len(keyframes), num_samples - num_clip_frames)
+        if num_keyframes + num_clip_frames == 0:
+            return None
+
+        images = []
+        for i in np.linspace(0, len(keyframes) - 1, num_keyframes).round().astype(int):
+            image_store, frame_id = keyframes[i]
+            images.append(open_image(image_store.get(frame_id)).convert("RGB"))
+        for i in np.linspace(0, len(clip_frames) - 1, num_clip_frames).round().astype(int):
+            # Clip frames are stored in BGR order
+            clip_store, frame_id = clip_frames[i]
+            images.append(Image.fromarray(np.ascontiguousarray(clip_store.get_frame(frame_id)[..., ::-1])))
+        return images
+
+    def _get_models(self):
+        # Image and video features and language models of the same model share their exported encoders
+        models = {}
+        configs = [("features", name) for name in (GlobalConfig.get("features") or {}).keys()]
+        configs += [
+            ("searcher", "language_models", name)
+            for name in (GlobalConfig.get("searcher", "language_models") or {}).keys()
+        ]
+        for keys in configs:
+            model_name = GlobalConfig.get(*keys, "model")
+            if model_name not in self.EXPORTABLE_MODELS:
+                continue
+
+            source = GlobalConfig.get(*keys, "source") or "hf"
+            arch_name = GlobalConfig.get(*keys, "arch_name") if source != "hf" else None
+            pretrained_model = GlobalConfig.get(*keys, "pretrained_model")
+            models.setdefault((source, arch_name, pretrained_model), (model_name, keys[-1]))
+        return models
@@ -12,6 +12,7 @@ import aic51.packages.constant as constant
 from aic51.packages.config import GlobalConfig
 from aic51.packages.index import MilvusDatabase
 from aic51.packages.logger import logger
+from aic51.packages.utils import FeatureStore
 
 from .command import BaseCommand
 
@@ -118,26 +119,28 @@ class IndexCommand(BaseCommand):
             if GlobalConfig.get("features", feature_name):
                 feature_fields.append(feature_name)
 
-        frame_features_paths = [x for x in video_features_dir.glob("*") if x.is_dir()]
+        # Each feature of the video is one memory-mapped store
+        features = {}
+        for feature_name in feature_fields:
+            if FeatureStore.exists(video_features_dir, feature_name):
+                frame_ids, feature_values = FeatureStore(video_features_dir, feature_name).get_all()
+                features[feature_name] = dict(zip(frame_ids, feature_values))
 
-        update_progress(description="Indexing", completed=0, total=len(frame_features_paths))
+        frame_ids = sorted(set().union(*[f.keys() for f in features.values()]))
 
-        for frame_features_path in frame_features_paths:
-            frame_id = frame_features_path.stem
+        update_progress(description="Indexing", completed=0, total=len(frame_ids))
+
+        for frame_id in frame_ids:
             data = {
-                "frame_id": f"{video_id}#{frame_id}",  # This is because Milvus does not allow composite primary key
+                "frame_id": f"{video_id}#{frame_id:06d}",  # This is because Milvus does not allow composite primary key
             }
-            for feature_path in frame_features_path.glob("*"):
-                feature_name = feature_path.stem
-                if feature_name not in feature_fields:
-                    continue
-                if feature_path.is_dir():
+            for feature_name, feature_values in features.items():
+                if frame_id not in feature_values:
                     continue
 
-                feature = np.load(feature_path)
-
-                if feature.dtype.kind == "U":
-                    feature = feature.tolist()
+                feature = feature_values[frame_id]
+                if isinstance(feature, np.ndarray):
+                    feature = np.array(feature)
 
                 data[feature_name] = feature
 
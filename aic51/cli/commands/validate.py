@@ -3,6 +3,7 @@ import os
 import shutil
 import subprocess
 import sys
+import time
 import wave
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
@@ -14,6 +15,18 @@ from rich.progress import Progress, SpinnerColumn, TextColumn, TimeElapsedColumn
 import aic51.packages.constant as constant
 from aic51.packages.config import GlobalConfig
 from aic51.packages.logger import logger
+from aic51.packages.media import (
+    ImageStore,
+    ImageWriter,
+    PackedImageStore,
+    create_image_store_writer,
+    load_media_info,
+    load_storyboard_index,
+    open_image_store,
+    read_frames,
+    save_storyboard,
+)
+from aic51.packages.utils.feature_store import FeatureStore, get_feature_names
 from aic51.packages.utils.files import get_path
 
 from .command import BaseCommand
@@ -23,6 +36,11 @@ class ValidateCommand(BaseCommand):
     SUPPORTED_EXT = [
         ".mp4",
     ]
+    STORYBOARD_CONFIG_KEYS = [
+        "storyboard_tile_width",
+        "storyboard_columns",
+        "storyboard_rows",
+    ]
 
     def __init__(self, *args, **kwargs):
         super(ValidateCommand, self).__init__(*args, **kwargs)
@@ -98,66 +116,95 @@ class ValidateCommand(BaseCommand):
 
         thumbnail_dir.mkdir(exist_ok=True, parents=True)
 
-        keyframes_list = set([int(f.stem) for f in feature_path.glob("*") if f.is_dir()])
+        keyframes_list = set()
+        for feature_name in get_feature_names(feature_path):
+            keyframes_list.update(FeatureStore(feature_path, feature_name).keys())
+
+        if do_fix:
+            media_info = self._get_media_info(video_path)
+        else:
+            media_info = None
+
+        update_progress(description=f"Validating", completed=0, total=len(keyframes_list))
+
+        thumbnail_store = open_image_store(thumbnail_dir)
+
+        missing_thumbnails = []
+        for frame_id in sorted(keyframes_list):
+            if frame_id not in thumbnail_store:
+                if do_fix:
+                    missing_thumbnails.append(frame_id)
+                else:
+                    logger.warning(f"video_id={video_id} keyframe_id={frame_id}: thumbnail not found")
+            update_progress(advance=1)
+
+        if len(missing_thumbnails) > 0:
+            self._fix_thumbnails(
+                video_path, thumbnail_dir, thumbnail_store, missing_thumbnails, media_info, update_progress
+            )
+            thumbnail_store = open_image_store(thumbnail_dir)
+
+        self._validate_storyboard(video_id, thumbnail_store, do_fix, update_progress)
+
+    def _fix_thumbnails(
+        self,
+        video_path: Path,
+        thumbnail_dir: Path,
+        thumbnail_store: ImageStore,
+        missing_thumbnails: list[int],
+        media_info: dict | None,
+        update_progress: Callable,
+    ):
+        update_progress(description=f"Fixing thumbnails", completed=0, total=len(missing_thumbnails))
 
         default_size = GlobalConfig.get("add", "default_size") or [1280, 720]
         keyframe_ratio = GlobalConfig.get("add", "keyframe_resize_ratio") or 0.5
         thumbnail_ratio = GlobalConfig.get("add", "thumbnail_resize_ratio") or 0.25
 
-        if do_fix:
-            self._extract_video_info(video_path)
+        resize_rate = keyframe_ratio * thumbnail_ratio
+        assert media_info is not None
+        keyframes_index = media_info[constant.KEYFRAMES_KEY]
+        image_writer_workers = GlobalConfig.get("add", "image_writer_workers") or 2
+        image_writer_pending = GlobalConfig.get("add", "image_writer_pending") or 32
 
-        cap = cv2.VideoCapture(str(video_path))
-        frame_counter = 0
+        # Fixed thumbnails keep the layout of the existing ones
+        image_format = "packed" if isinstance(thumbnail_store, PackedImageStore) else "jpg"
+        with (
+            create_image_store_writer(thumbnail_dir, image_format, f"fix_{time.time_ns()}") as thumbnail_writer,
+            ImageWriter(image_writer_workers, image_writer_pending) as image_writer,
+        ):
+            for frame_id, frame in read_frames(video_path, missing_thumbnails, keyframes_index):
+                thumbnail = cv2.resize(frame, [int(s * resize_rate) for s in default_size])
+                image_writer.write(thumbnail_writer, frame_id, thumbnail)
+                update_progress(advance=1)
 
-        update_progress(description=f"Validating", completed=0, total=len(keyframes_list))
+    def _validate_storyboard(
+        self, video_id: str, thumbnail_store: ImageStore, do_fix: bool, update_progress: Callable
+    ):
+        storyboard_dir = self._work_dir / constant.STORYBOARD_DIR / f"{video_id}"
 
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
+        storyboard_index = load_storyboard_index(storyboard_dir)
+        storyboard_frame_ids = [tile["frame_id"] for tile in (storyboard_index or {}).get("tiles", [])]
+        if storyboard_frame_ids == thumbnail_store.keys():
+            return
 
-            if frame_counter in keyframes_list:
-                update_progress(advance=1)
+        # Storyboards are optional, a missing one is only reported when the add config sets them up
+        if not do_fix:
+            if storyboard_index is not None:
+                logger.warning(f"video_id={video_id}: storyboard is outdated")
+            elif any(GlobalConfig.get("add", k) is not None for k in self.STORYBOARD_CONFIG_KEYS):
+                logger.warning(f"video_id={video_id}: storyboard is missing")
+            return
+
+        update_progress(description=f"Fixing storyboard", completed=0, total=1)
+
+        tile_width = GlobalConfig.get("add", "storyboard_tile_width") or 160
+        columns = GlobalConfig.get("add", "storyboard_columns") or 10
+        rows = GlobalConfig.get("add", "storyboard_rows") or 10
+        save_storyboard(storyboard_dir, thumbnail_store, tile_width, columns, rows)
+
+        update_progress(advance=1)
 
-                thumbnail_path = thumbnail_dir / f"{frame_counter:06d}.jpg"
-                if not thumbnail_path.exists():
-                    if do_fix:
-                        resize_rate = keyframe_ratio * thumbnail_ratio
-                        thumbnail = cv2.resize(frame, [int(s * resize_rate) for s in default_size])
-                        cv2.imwrite(
-                            str(thumbnail_path),
-                            thumbnail,
-                            [cv2.IMWRITE_JPEG_QUALITY, 50],
-                        )
-                    else:
-                        logger.warning(
-                            f"video_id={video_id} keyframe_id={frame_counter}: thumbnail not found"
-                        )
-
-            frame_counter += 1
-
-        cap.release()
-
-    def _extract_video_info(self, video_path: Path):
-        info_file = self._work_dir / constant.VIDEO_INFO_DIR / f"{video_path.stem}.json"
-        info_file.parent.mkdir(parents=True, exist_ok=True)
-
-        data = {constant.FPS_KEY: self._get_fps(video_path)}
-        with open(info_file, "w") as f:
-            json.dump(data, f)
-
-    def _get_fps(self, video_path: Path):
-        ffprobe_cmd = ["ffprobe", "-v", "quiet", "-of", "compact=p=0"] + [
-            "-select_streams",
-            "0",
-            "-show_entries",
-            "stream=r_frame_rate",
-            str(video_path),
-        ]
-        res = subprocess.run(ffprobe_cmd, capture_output=True, text=True)
-
-        fraction = str(res.stdout).split("=")[1].split("/")
-        fps = round(int(fraction[0]) / int(fraction[1]))
-
-        return fps
+    def _get_media_info(self, video_path: Path):
+        info_path = self._work_dir / constant.VIDEO_INFO_DIR / f"{video_path.stem}.json"
+        return load_media_info(info_path, video_path)
@@ -1 +1,2 @@
-from .features import FeatureExtractor, FeatureExtractorFactory
+from .features import FeatureExtractor, FeatureExtractorFactory, FrameEmbeddingCache, ModelRegistry
+from .processors import AnalyseProcessor
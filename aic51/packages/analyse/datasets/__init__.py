@@ -1 +1 @@
-from .common import ImageDataset, VideoDataset
+from .common import ImageDataset, VideoDataset, sample_frame_indices
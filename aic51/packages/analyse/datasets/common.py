@@ -8,13 +8,18 @@ import torchvision.transforms.functional as F
 from PIL import Image
 from torch.utils.data import Dataset
 
+import aic51.packages.constant as constant
 from aic51.packages.logger import logger
+from aic51.packages.media import Clip, open_image
 from aic51.packages.utils.files import get_path
 
 
 class ImageDataset(Dataset):
     def __init__(
-        self, images: list[Path | str] | torch.Tensor | np.ndarray | list[Image.Image], transform: Optional[Callable]
+        self,
+        images: list[Path | str] | torch.Tensor | np.ndarray | list[Image.Image],
+        transform: Optional[Callable],
+        draft_size: Optional[tuple[int, int]] = None,
     ) -> None:
         self.samples = []
         for image in images:
@@ -24,6 +29,7 @@ class ImageDataset(Dataset):
             self.samples.append(image)
 
         self.transform = transform
+        self.draft_size = draft_size
 
     def __len__(self):
         return len(self.samples)
@@ -31,8 +37,8 @@ class ImageDataset(Dataset):
     def __getitem__(self, index):
         sample = self.samples[index]
 
-        if isinstance(sample, (Path, str)):
-            sample = Image.open(self.samples[index])
+        if isinstance(sample, (Path, str)) or (isinstance(sample, np.ndarray) and sample.ndim == 1):
+            sample = open_image(sample, self.draft_size)
 
         if self.transform:
             sample = self.transform(sample)
@@ -40,9 +46,22 @@ class ImageDataset(Dataset):
         return sample
 
 
+def sample_frame_indices(num_frames: int, num_samples: int = constant.NUM_FRAMES_VIDEO_FEATURE) -> np.ndarray:
+    # Middle frames of num_samples equal segments, frames are repeated in clips shorter than num_samples
+    if num_frames == 0:
+        raise RuntimeError("VideoDataset: clip has no frames")
+    return ((np.arange(num_samples) + 0.5) * num_frames / num_samples).astype(np.int64)
+
+
 class VideoDataset(Dataset):
+    # Seeking is used over grabbing the frames in between when the next sampled frame is further than this
+    SEEK_GAP = 32
+
     def __init__(
-        self, videos: list[Path | str] | torch.Tensor | np.ndarray | list[Image.Image], transform: Optional[Callable]
+        self,
+        videos: list[Path | str] | torch.Tensor | np.ndarray | list[Image.Image],
+        transform: Optional[Callable],
+        num_frames: int = constant.NUM_FRAMES_VIDEO_FEATURE,
     ) -> None:
         self.samples = []
         for video in videos:
@@ -52,15 +71,27 @@ class VideoDataset(Dataset):
             self.samples.append(video)
 
         self.transform = transform
+        self.num_frames = num_frames
 
     def __len__(self):
         return len(self.samples)
 
     def __getitem__(self, index):
+        # Samples are num_frames frames (N x H x W x 3, RGB) uniformly sampled from the clip
         sample = self.samples[index]
 
-        if isinstance(sample, (Path, str)):
+        if isinstance(sample, Clip):
+            # Only the sampled frames are read from the clip store, they are stored in BGR order
+            indices = sample_frame_indices(len(sample), self.num_frames)
+            sample = np.ascontiguousarray(np.stack([sample.get_frame(i) for i in indices], axis=0)[..., ::-1])
+        elif isinstance(sample, (Path, str)):
             sample = self.__read_video(get_path(sample))
+        elif isinstance(sample, np.ndarray):
+            # Packed clips are stored in BGR order, only the sampled frames are read
+            sample = np.ascontiguousarray(sample[sample_frame_indices(len(sample), self.num_frames)][..., ::-1])
+        else:
+            sample = np.stack([np.asarray(image.convert("RGB")) for image in sample], axis=0)
+            sample = sample[sample_frame_indices(len(sample), self.num_frames)]
 
         if self.transform:
             sample = self.transform(sample)
@@ -70,12 +101,47 @@ class VideoDataset(Dataset):
     def __read_video(self, video_path: Path):
         frames = []
         cap = cv2.VideoCapture(str(video_path))
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-
-            frames.append(Image.fromarray(frame))
-        cap.release()
-
-        return frames
+        try:
+            frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            if frame_count <= 0:
+                # Containers without a frame count are read whole
+                while True:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    frames.append(frame)
+                frames = np.stack([frames[i] for i in sample_frame_indices(len(frames), self.num_frames)], axis=0)
+                return np.ascontiguousarray(frames[..., ::-1])
+
+            indices = sample_frame_indices(frame_count, self.num_frames)
+            position = 0
+            frame = None
+            for i in indices:
+                if i - position > self.SEEK_GAP:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, int(i))
+                    position = int(i)
+
+                # Frames in between are decoded but not converted
+                while position <= i:
+                    if not cap.grab():
+                        break
+                    position += 1
+                    frame = None
+
+                if position > i and frame is None:
+                    ret, frame = cap.retrieve()
+                    if not ret:
+                        frame = None
+                if frame is None:
+                    # The frame count of the container may be larger than the decodable frames
+                    break
+                frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        finally:
+            cap.release()
+
+        if len(frames) == 0:
+            raise RuntimeError(f"VideoDataset: cannot read {video_path}")
+        while len(frames) < self.num_frames:
+            frames.append(frames[-1])
+
+        return np.stack(frames, axis=0)
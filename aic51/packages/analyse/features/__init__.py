@@ -2,4 +2,7 @@ from .image_clip import ImageCLIP
 from .video_clip import VideoCLIP
 from .ocr import OCR
 from .feature_extractor import FeatureExtractor, FeatureExtractorFactory
+from .frame_cache import FrameEmbeddingCache
+from .models import ModelRegistry
 
+from .runtime import EncoderModule, ExportedEncoder, export_encoder, check_parity
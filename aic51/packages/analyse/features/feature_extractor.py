@@ -50,7 +50,11 @@ class FeatureExtractor(ABC):
         self,
         images: list[Path | str] | np.ndarray | torch.Tensor | list[Image.Image],
         callback: Optional[Callable] = None,
+        sink: Optional[Callable] = None,
+        keys: Optional[list[Any]] = None,
     ) -> np.ndarray:
+        # sink(start, batch_features) receives the features of each batch as soon as they are computed, keys are the
+        # (video_id, keyframe) of the inputs when analysed
         pass
 
     @abstractmethod
@@ -61,6 +65,54 @@ class FeatureExtractor(ABC):
     def to(self, device: str | torch.device):
         pass
 
+    def set_num_workers(self, num_workers: int):
+        # Only extractors running their own workers have a budget of their own, torch threads are shared by the
+        # whole process (analyse.torch_threads)
+        pass
+
+    def close(self):
+        # Releases the models shared with other extractors
+        pass
+
+    def get_draft_size(self) -> Optional[tuple[int, int]]:
+        # Smallest size images can be decoded at without changing the features, None for the full resolution
+        return None
+
+    def get_image_transform(self) -> Optional[Callable]:
+        # Transform of one decoded image into a C x H x W model input. The processor runs it in its decode threads and
+        # passes the transformed images stacked in one tensor to get_features. None to get the decoded images
+        return None
+
+
+class FeatureOutput:
+    # The output is allocated once with the shape of the first batch and batches are copied in, with a sink batches
+    # are only passed to the sink
+    def __init__(self, num_samples: int, sink: Optional[Callable] = None):
+        self._num_samples = num_samples
+        self._sink = sink
+        self._features = None
+        self._size = 0
+
+    def write(self, batch_features: torch.Tensor | np.ndarray):
+        if isinstance(batch_features, torch.Tensor):
+            batch_features = batch_features.cpu().numpy()
+
+        if self._sink:
+            self._sink(self._size, batch_features)
+        else:
+            if self._features is None:
+                shape = (self._num_samples, *batch_features.shape[1:])
+                self._features = np.empty(shape, dtype=batch_features.dtype)
+            self._features[self._size : self._size + len(batch_features)] = batch_features
+        self._size += len(batch_features)
+
+    @property
+    def features(self) -> np.ndarray:
+        if self._features is None:
+            return np.empty(0, dtype=np.float32)
+        return self._features[: self._size]
+
+
 class FeatureExtractorFactory:
     __registry = {}
 
@@ -0,0 +1,46 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+import numpy as np
+
+
+class FrameEmbeddingCache:
+    # Embeddings of the frames of packed clips keyed by (model, video, frame), shared by the clips and the video
+    # features of the same model. The least recently used embeddings are dropped once max_size embeddings are held
+    def __init__(self, max_size: int = 65536):
+        self._max_size = max_size
+        self._embeddings = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._embeddings)
+
+    def get(self, model_id: str, keys: list[tuple[str, int]]) -> list[Optional[np.ndarray]]:
+        res = []
+        with self._lock:
+            for video_id, frame_id in keys:
+                embedding = self._embeddings.get((model_id, video_id, frame_id))
+                if embedding is not None:
+                    self._embeddings.move_to_end((model_id, video_id, frame_id))
+                    self._hits += 1
+                else:
+                    self._misses += 1
+                res.append(embedding)
+        return res
+
+    def put(self, model_id: str, keys: list[tuple[str, int]], embeddings: np.ndarray):
+        with self._lock:
+            for (video_id, frame_id), embedding in zip(keys, embeddings):
+                self._embeddings[(model_id, video_id, frame_id)] = embedding
+                self._embeddings.move_to_end((model_id, video_id, frame_id))
+
+            while len(self._embeddings) > self._max_size:
+                self._embeddings.popitem(last=False)
+
+    def get_hit_rate(self) -> float:
+        with self._lock:
+            total = self._hits + self._misses
+            return self._hits / total if total > 0 else 0.0
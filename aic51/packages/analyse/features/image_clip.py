@@ -2,17 +2,18 @@ from pathlib import Path
 from typing import Any, Callable, Literal, Optional
 
 import numpy as np
-import open_clip
 import torch
 from PIL import Image
 from torch.utils.data import DataLoader
-from transformers import AutoModel, AutoProcessor
 
 import aic51.packages.constant as constant
 from aic51.packages.analyse.datasets import ImageDataset
 from aic51.packages.config import GlobalConfig
 
-from .feature_extractor import FeatureExtractor, FeatureExtractorFactory
+from .feature_extractor import FeatureExtractor, FeatureExtractorFactory, FeatureOutput
+from .models import SharedModel
+from .preprocess import get_hf_batch_preprocess, get_open_clip_batch_preprocess
+from .runtime import EXAMPLE_TEXTS, EncoderModule, get_export_dir, load_encoder
 
 
 @FeatureExtractorFactory.register("image_clip")
@@ -28,15 +29,13 @@ class ImageCLIP(FeatureExtractor):
         else:
             raise RuntimeError(f"CLIP: source={source} is invalid")
 
+    def get_image_transform(self) -> Optional[Callable]:
+        batch_preprocess = self._batch_preprocess
+        if batch_preprocess.transform is not None:
+            return batch_preprocess.transform
 
-class HFProcessorWrapper:
-    def __init__(self, processor):
-        self._processor = processor
-
-    def __call__(self, image):
-        processed_data = self._processor(images=[image], return_tensors="pt")
-        processed_data["pixel_values"] = processed_data["pixel_values"].squeeze(0)
-        return processed_data
+        # HF processors resize and crop each image of a batch on its own
+        return lambda image: batch_preprocess.collate_fn([image])[0]
 
 
 class ImageHFCLIP(ImageCLIP):
@@ -54,13 +53,13 @@ class ImageHFCLIP(ImageCLIP):
         name: str = "clip",
         batch_size: int = 1,
         device: torch.device = torch.device("cpu"),
+        runtime: str = "torch",
         *args,
         **kwargs,
     ):
-        self._model = AutoModel.from_pretrained(pretrained_model)
-        self._processor = AutoProcessor.from_pretrained(pretrained_model)
-
-        self._model.eval()
+        # The model is loaded or shared when the extractor is moved to its device
+        self._shared_model = SharedModel("hf", None, pretrained_model, weights=runtime == "torch")
+        self._runtime = runtime
 
         super().__init__(name, batch_size, device)
 
@@ -68,36 +67,41 @@ class ImageHFCLIP(ImageCLIP):
         self,
         images: list[Path | str] | np.ndarray | torch.Tensor | list[Image.Image],
         callback: Optional[Callable] = None,
+        sink: Optional[Callable] = None,
+        keys: Optional[list[Any]] = None,
     ) -> np.ndarray:
 
-        dataset = ImageDataset(images, HFProcessorWrapper(self._processor))
-
-        dataloader = DataLoader(
-            dataset=dataset,
-            batch_size=self._batch_size,
-            shuffle=False,
-            drop_last=False,
-            num_workers=GlobalConfig.get("analyse", "num_workers") or 0,
-            pin_memory=(True if GlobalConfig.get("analyse", "pin_memory") else False),
-        )
-
-        image_features = torch.Tensor(0).to(self._device)
-        num_batches = len(dataloader)
+        if isinstance(images, torch.Tensor):
+            # Images already transformed with get_image_transform are batched as they are
+            batches = images.split(self._batch_size)
+        else:
+            batches = DataLoader(
+                dataset=ImageDataset(images, self._batch_preprocess.transform, self._batch_preprocess.draft_size),
+                batch_size=self._batch_size,
+                shuffle=False,
+                drop_last=False,
+                num_workers=GlobalConfig.get("analyse", "num_workers") or 0,
+                pin_memory=(True if GlobalConfig.get("analyse", "pin_memory") else False),
+                collate_fn=self._batch_preprocess.collate_fn,
+            )
+
+        output = FeatureOutput(len(images), sink)
+        num_batches = len(batches)
 
         with torch.no_grad():
             if callback:
-                callback(self, 0, num_batches, image_features)
+                callback(self, 0, num_batches, output.features)
 
-            for i, data in enumerate(dataloader):
-                data = data.to(self._device)
-                batch_features = self._model.get_image_features(**data)
-                image_features = torch.cat([image_features, batch_features])
+            for i, data in enumerate(batches):
+                data = self._batch_preprocess.normalize(data, self._device)
+                batch_features = self._image_encoder(data)
+                batch_features /= batch_features.norm(dim=-1, keepdim=True)
+                output.write(batch_features)
 
                 if callback:
-                    callback(self, i + 1, num_batches, image_features)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
+                    callback(self, i + 1, num_batches, output.features)
 
-        return image_features.cpu().numpy()
+        return output.features
 
     def get_text_features(self, texts: list[str] | str | np.ndarray, callback: Optional[Callable] = None) -> Any:
         if isinstance(texts, np.ndarray):
@@ -105,23 +109,54 @@ class ImageHFCLIP(ImageCLIP):
         if isinstance(texts, str):
             texts = [texts]
 
-        tokenized_input = self._processor(text=texts, return_tensors="pt", padding=True).to(self._device)
+        tokenized_input = self._tokenize(texts).to(self._device)
         with torch.no_grad():
-            text_features = self._model.get_text_features(**tokenized_input)
+            text_features = self._text_encoder(*tokenized_input.values())
             text_features /= text_features.norm(dim=-1, keepdim=True)
         return text_features.cpu().numpy()
 
     def to(self, device: str | torch.device):
         self._device = torch.device(device)
-        self._model.to(self._device)
-
-
-class OpenCLIPPreprocessWrapper:
-    def __init__(self, preprocess):
-        self._preprocess = preprocess
-
-    def __call__(self, image):
-        return self._preprocess(image)
+        if self._shared_model.to(self._device):
+            self._model, self._processor = self._shared_model.components
+            self._batch_preprocess = get_hf_batch_preprocess(self._processor)
+
+            export_dir = get_export_dir("hf", None, self._shared_model.pretrained_model)
+            self._image_encoder = load_encoder(
+                EncoderModule(self._model, "get_image_features"), export_dir, "image", self._runtime, self._device
+            )
+            self._text_encoder = load_encoder(
+                EncoderModule(self._model, "get_text_features"), export_dir, "text", self._runtime, self._device
+            )
+        self._batch_preprocess.to(self._device)
+
+    def close(self):
+        self._shared_model.release()
+
+    def get_draft_size(self) -> Optional[tuple[int, int]]:
+        return self._batch_preprocess.draft_size
+
+    def get_encoders(
+        self, images: Optional[list[Image.Image]] = None
+    ) -> dict[str, tuple[EncoderModule, tuple[torch.Tensor, ...]]]:
+        # Eager encoders with example inputs to export and check them, images are random without samples
+        if self._runtime != "torch":
+            raise RuntimeError(f"{self.name}: encoders are already exported to {self._runtime}")
+
+        if images is None:
+            images = [Image.fromarray(np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8)) for _ in EXAMPLE_TEXTS]
+        pixel_values = self._processor(images=images, return_tensors="pt")["pixel_values"]
+        tokenized_input = self._tokenize(EXAMPLE_TEXTS, padding="max_length")
+        return {
+            "image": (self._image_encoder, (pixel_values,)),
+            "text": (self._text_encoder, tuple(tokenized_input.values())),
+        }
+
+    def _tokenize(self, texts: list[str], padding: bool | str = True):
+        # Exported text encoders are traced with inputs padded to the maximum length
+        if self._runtime != "torch":
+            padding = "max_length"
+        return self._processor(text=texts, return_tensors="pt", padding=padding)
 
 
 class ImageOpenCLIP(ImageCLIP):
@@ -140,17 +175,13 @@ class ImageOpenCLIP(ImageCLIP):
         name: str = "clip",
         batch_size: int = 1,
         device: torch.device = torch.device("cpu"),
+        runtime: str = "torch",
         *args,
         **kwargs,
     ):
-        model, _, preprocess = open_clip.create_model_and_transforms(arch_name, pretrained_model)
-        tokenizer = open_clip.get_tokenizer(arch_name)
-
-        self._model = model
-        self._preprocess = preprocess
-        self._tokenizer = tokenizer
-
-        self._model.eval()
+        # The model is loaded or shared when the extractor is moved to its device
+        self._shared_model = SharedModel("open_clip", arch_name, pretrained_model, weights=runtime == "torch")
+        self._runtime = runtime
 
         super().__init__(name, batch_size, device)
 
@@ -158,37 +189,41 @@ class ImageOpenCLIP(ImageCLIP):
         self,
         images: list[Path | str] | np.ndarray | torch.Tensor | list[Image.Image],
         callback: Optional[Callable] = None,
+        sink: Optional[Callable] = None,
+        keys: Optional[list[Any]] = None,
     ) -> np.ndarray:
 
-        dataset = ImageDataset(images, OpenCLIPPreprocessWrapper(self._preprocess))
-
-        dataloader = DataLoader(
-            dataset=dataset,
-            batch_size=self._batch_size,
-            shuffle=False,
-            drop_last=False,
-            num_workers=GlobalConfig.get("analyse", "num_workers") or 0,
-            pin_memory=(True if GlobalConfig.get("analyse", "pin_memory") else False),
-        )
-
-        image_features = torch.Tensor(0).to(self._device)
-        num_batches = len(dataloader)
+        if isinstance(images, torch.Tensor):
+            # Images already transformed with get_image_transform are batched as they are
+            batches = images.split(self._batch_size)
+        else:
+            batches = DataLoader(
+                dataset=ImageDataset(images, self._batch_preprocess.transform, self._batch_preprocess.draft_size),
+                batch_size=self._batch_size,
+                shuffle=False,
+                drop_last=False,
+                num_workers=GlobalConfig.get("analyse", "num_workers") or 0,
+                pin_memory=(True if GlobalConfig.get("analyse", "pin_memory") else False),
+                collate_fn=self._batch_preprocess.collate_fn,
+            )
+
+        output = FeatureOutput(len(images), sink)
+        num_batches = len(batches)
 
         with torch.no_grad():
             if callback:
-                callback(self, 0, num_batches, image_features)
+                callback(self, 0, num_batches, output.features)
 
-            for i, data in enumerate(dataloader):
-                data = data.to(self._device)
-                batch_features = self._model.encode_image(data)
-                image_features = torch.cat([image_features, batch_features])
+            for i, data in enumerate(batches):
+                data = self._batch_preprocess.normalize(data, self._device)
+                batch_features = self._image_encoder(data)
+                batch_features /= batch_features.norm(dim=-1, keepdim=True)
+                output.write(batch_features)
 
                 if callback:
-                    callback(self, i + 1, num_batches, image_features)
-
-            image_features /= image_features.norm(dim=-1, keepdim=True)
+                    callback(self, i + 1, num_batches, output.features)
 
-        return image_features.cpu().numpy()
+        return output.features
 
     def get_text_features(self, texts: list[str] | str | np.ndarray, callback: Optional[Callable] = None) -> Any:
         if isinstance(texts, np.ndarray):
@@ -198,11 +233,44 @@ class ImageOpenCLIP(ImageCLIP):
 
         tokenized_input = self._tokenizer(texts).to(self._device)
         with torch.no_grad():
-            text_features = self._model.encode_text(tokenized_input)
+            text_features = self._text_encoder(tokenized_input)
             text_features /= text_features.norm(dim=-1, keepdim=True)
 
         return text_features.cpu().numpy()
 
     def to(self, device: str | torch.device):
         self._device = torch.device(device)
-        self._model.to(self._device)
+        if self._shared_model.to(self._device):
+            self._model, self._preprocess, self._tokenizer = self._shared_model.components
+            self._batch_preprocess = get_open_clip_batch_preprocess(self._preprocess)
+
+            shared_model = self._shared_model
+            export_dir = get_export_dir("open_clip", shared_model.arch_name, shared_model.pretrained_model)
+            self._image_encoder = load_encoder(
+                EncoderModule(self._model, "encode_image"), export_dir, "image", self._runtime, self._device
+            )
+            self._text_encoder = load_encoder(
+                EncoderModule(self._model, "encode_text"), export_dir, "text", self._runtime, self._device
+            )
+        self._batch_preprocess.to(self._device)
+
+    def close(self):
+        self._shared_model.release()
+
+    def get_draft_size(self) -> Optional[tuple[int, int]]:
+        return self._batch_preprocess.draft_size
+
+    def get_encoders(
+        self, images: Optional[list[Image.Image]] = None
+    ) -> dict[str, tuple[EncoderModule, tuple[torch.Tensor, ...]]]:
+        # Eager encoders with example inputs to export and check them, images are random without samples
+        if self._runtime != "torch":
+            raise RuntimeError(f"{self.name}: encoders are already exported to {self._runtime}")
+
+        if images is None:
+            images = [Image.fromarray(np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8)) for _ in EXAMPLE_TEXTS]
+        pixel_values = torch.stack([self._preprocess(image) for image in images], dim=0)
+        return {
+            "image": (self._image_encoder, (pixel_values,)),
+            "text": (self._text_encoder, (self._tokenizer(EXAMPLE_TEXTS),)),
+        }
@@ -0,0 +1,123 @@
+from threading import Lock
+from typing import Any, Callable
+
+import open_clip
+import torch
+from open_clip.transform import PreprocessCfg, image_transform_v2, merge_preprocess_dict
+from transformers import AutoModel, AutoProcessor
+
+from aic51.packages.logger import logger
+
+from .runtime import get_model_id
+
+
+def load_hf_model(pretrained_model: str, device: torch.device) -> tuple[Any, Any]:
+    model = AutoModel.from_pretrained(pretrained_model)
+    processor = AutoProcessor.from_pretrained(pretrained_model)
+    return model.eval().to(device), processor
+
+
+def load_hf_processor(pretrained_model: str) -> tuple[None, Any]:
+    return None, AutoProcessor.from_pretrained(pretrained_model)
+
+
+def load_open_clip_model(arch_name: str, pretrained_model: str, device: torch.device) -> tuple[Any, Any, Any]:
+    model, _, preprocess = open_clip.create_model_and_transforms(arch_name, pretrained_model)
+    tokenizer = open_clip.get_tokenizer(arch_name)
+    return model.eval().to(device), preprocess, tokenizer
+
+
+def load_open_clip_transforms(arch_name: str, pretrained_model: str) -> tuple[None, Any, Any]:
+    # Same preprocess as create_model_and_transforms, built from the configs of the model without creating it
+    model_cfg = open_clip.get_model_config(arch_name)
+    if model_cfg is None:
+        raise RuntimeError(f"ModelRegistry: no config for arch_name={arch_name}, use runtime=torch")
+
+    preprocess_cfg = merge_preprocess_dict(PreprocessCfg(), model_cfg.get("preprocess_cfg", {}))
+    preprocess_cfg = merge_preprocess_dict(preprocess_cfg, open_clip.get_pretrained_cfg(arch_name, pretrained_model))
+    preprocess_cfg["size"] = model_cfg["vision_cfg"]["image_size"]
+    preprocess = image_transform_v2(PreprocessCfg(**preprocess_cfg), is_train=False)
+    return None, preprocess, open_clip.get_tokenizer(arch_name)
+
+
+class ModelRegistry:
+    # Models loaded in the process, keyed by (source, arch_name, pretrained_model, device) and shared by every
+    # extractor using them, device is None for models loaded without their weights. A model is dropped once every
+    # extractor holding it released it
+    __models = {}
+    __lock = Lock()
+
+    @staticmethod
+    def acquire(key: tuple, load: Callable[[], Any]) -> Any:
+        with ModelRegistry.__lock:
+            if key not in ModelRegistry.__models:
+                logger.debug(f"ModelRegistry: loading {key}")
+                ModelRegistry.__models[key] = [load(), 0]
+
+            entry = ModelRegistry.__models[key]
+            entry[1] += 1
+            return entry[0]
+
+    @staticmethod
+    def release(key: tuple):
+        with ModelRegistry.__lock:
+            entry = ModelRegistry.__models.get(key)
+            if entry is None:
+                return
+
+            entry[1] -= 1
+            if entry[1] <= 0:
+                logger.debug(f"ModelRegistry: releasing {key}")
+                del ModelRegistry.__models[key]
+
+    @staticmethod
+    def get_ref_count(key: tuple) -> int:
+        with ModelRegistry.__lock:
+            entry = ModelRegistry.__models.get(key)
+            return entry[1] if entry is not None else 0
+
+
+class SharedModel:
+    # Reference of an extractor to a model of the registry, moving it to another device swaps it for the model
+    # loaded on that device. Without weights only the preprocess and tokenizer are loaded and the model is None,
+    # for extractors running exported encoders
+    def __init__(self, source: str, arch_name: str | None, pretrained_model: str, weights: bool = True):
+        self.source = source
+        self.arch_name = arch_name
+        self.pretrained_model = pretrained_model
+        self.weights = weights
+        self.model_id = get_model_id(source, arch_name, pretrained_model)
+        self.components = None
+        self._key = None
+
+    def to(self, device: str | torch.device) -> bool:
+        # Returns whether the components changed
+        device = torch.device(device)
+        key = (self.source, self.arch_name, self.pretrained_model, str(device) if self.weights else None)
+        if key == self._key:
+            return False
+
+        components = ModelRegistry.acquire(key, lambda: self._load(device))
+        self.release()
+        self._key = key
+        self.components = components
+        return True
+
+    def release(self):
+        if self._key is not None:
+            ModelRegistry.release(self._key)
+            self._key = None
+            self.components = None
+
+    def _load(self, device: torch.device):
+        if self.source == "hf":
+            if not self.weights:
+                return load_hf_processor(self.pretrained_model)
+            return load_hf_model(self.pretrained_model, device)
+        elif self.source == "open_clip":
+            assert self.arch_name is not None
+            if not self.weights:
+                return load_open_clip_transforms(self.arch_name, self.pretrained_model)
+            return load_open_clip_model(self.arch_name, self.pretrained_model, device)
+        else:
+            raise RuntimeError(f"ModelRegistry: source={self.source} is invalid")
@@ -11,6 +11,7 @@ from PIL import Image
 
 import aic51.packages.constant as constant
 from aic51.packages.logger import logger
+from aic51.packages.media import open_image
 
 from .feature_extractor import FeatureExtractor, FeatureExtractorFactory
 
@@ -33,23 +34,28 @@ class Tesseract(OCR):
     def __init__(self, name: str = "ocr", batch_size: int = 1, *args, **kwargs):
         self.name = name
         self._batch_size = batch_size
+        self._num_workers = batch_size
 
     def get_features(
         self,
         images: list[Path | str] | np.ndarray | torch.Tensor | list[Image.Image],
         callback: Optional[Callable] = None,
+        sink: Optional[Callable] = None,
+        keys: Optional[list[Any]] = None,
     ) -> np.ndarray:
         image_features = []
         num_batches = ceil(len(images) / self._batch_size)
         if callback:
             callback(self, 0, num_batches, image_features)
 
-        with ThreadPoolExecutor(self._batch_size) as executor:
+        with ThreadPoolExecutor(self._num_workers) as executor:
 
             def process_one_image(image):
-                name = image.stem
-                if isinstance(image, (str, Path)):
-                    image = Image.open(image)
+                if isinstance(image, (str, Path)) or (isinstance(image, np.ndarray) and image.ndim == 1):
+                    image = open_image(image)
+
+                # Decoded images shared with other extractors are cropped the same way as the files
+                if isinstance(image, Image.Image):
                     width, height = image.size
                     image = image.crop((0, 0, width, round(height * 8 / 9)))
 
@@ -68,6 +74,10 @@ class Tesseract(OCR):
                     data = future.result()
                     image_features.append(np.array(data))
 
+                # Texts have different lengths, they are not copied into a preallocated output
+                if sink:
+                    sink(b * self._batch_size, np.array(image_features[b * self._batch_size :]))
+
                 if callback:
                     callback(self, b + 1, num_batches, image_features)
 
@@ -83,3 +93,7 @@ class Tesseract(OCR):
 
     def to(self, device):
         pass
+
+    def set_num_workers(self, num_workers: int):
+        # Number of tesseract processes running at once
+        self._num_workers = num_workers
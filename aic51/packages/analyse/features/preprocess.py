@@ -0,0 +1,108 @@
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+import torchvision.transforms as T
+from PIL import Image
+
+
+class BatchPreprocess:
+    # Images are loaded as uint8 tensors at the input size of the model and normalized once per batch on the device
+    def __init__(
+        self,
+        transform: Optional[Callable],
+        collate_fn: Optional[Callable],
+        frames_transform: Callable,
+        draft_size: Optional[tuple[int, int]],
+        scale: float,
+        mean: list[float],
+        std: list[float],
+    ):
+        self.transform = transform
+        self.collate_fn = collate_fn
+        self.frames_transform = frames_transform
+        self.draft_size = draft_size
+
+        std_tensor = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self._weight = scale / std_tensor
+        self._bias = -torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1) / std_tensor
+
+    def to(self, device: str | torch.device):
+        self._weight = self._weight.to(device)
+        self._bias = self._bias.to(device)
+
+    def normalize(self, images: torch.Tensor, device: torch.device) -> torch.Tensor:
+        # images are N x C x H x W or B x N x C x H x W
+        images = images.to(device, non_blocking=True).float()
+        return torch.addcmul(self._bias, images, self._weight)
+
+
+class HFBatchProcessor:
+    # Resizes and crops a batch of images in one processor call, rescaling and normalization are left to the batch
+    # preprocess
+    def __init__(self, processor):
+        self._image_processor = processor.image_processor
+
+    def __call__(self, images: list[Image.Image] | np.ndarray) -> torch.Tensor:
+        pixel_values = self._image_processor(
+            images=list(images), do_rescale=False, do_normalize=False, return_tensors="pt"
+        )["pixel_values"]
+        if pixel_values.dtype != torch.uint8:
+            pixel_values = pixel_values.round().clamp(0, 255).to(torch.uint8)
+        return pixel_values
+
+
+class FramesTransform:
+    # Preprocesses the frames of a clip (N x H x W x 3, RGB) into one N x C x H x W tensor
+    def __init__(self, tensor_transform: Optional[Callable] = None, image_transform: Optional[Callable] = None):
+        self._tensor_transform = tensor_transform
+        self._image_transform = image_transform
+
+    def __call__(self, frames: np.ndarray) -> torch.Tensor:
+        if self._tensor_transform is not None:
+            frames = torch.from_numpy(np.ascontiguousarray(frames)).permute(0, 3, 1, 2)
+            return self._tensor_transform(frames)
+        return torch.stack([self._image_transform(Image.fromarray(frame)) for frame in frames], dim=0)
+
+
+def get_hf_batch_preprocess(processor) -> BatchPreprocess:
+    image_processor = processor.image_processor
+
+    size = image_processor.size
+    size = max(v for v in size.values() if isinstance(v, int)) if isinstance(size, dict) else size
+    scale = image_processor.rescale_factor if getattr(image_processor, "do_rescale", True) else 1.0
+    if getattr(image_processor, "do_normalize", True):
+        mean, std = image_processor.image_mean, image_processor.image_std
+    else:
+        mean, std = [0.0, 0.0, 0.0], [1.0, 1.0, 1.0]
+
+    batch_processor = HFBatchProcessor(processor)
+    return BatchPreprocess(None, batch_processor, batch_processor, (size, size), scale, mean, std)
+
+
+def get_open_clip_batch_preprocess(preprocess) -> BatchPreprocess:
+    transforms = list(preprocess.transforms) if isinstance(preprocess, T.Compose) else []
+    draft_size = None
+    for t in transforms:
+        if isinstance(t, T.Resize):
+            size = max(t.size) if isinstance(t.size, (list, tuple)) else t.size
+            draft_size = (size, size)
+
+    # Transforms ending with ToTensor and Normalize are split so that images stay uint8 until the batch is normalized
+    if len(transforms) >= 2 and isinstance(transforms[-2], T.ToTensor) and isinstance(transforms[-1], T.Normalize):
+        transform = T.Compose(transforms[:-2] + [T.PILToTensor()])
+        normalize = transforms[-1]
+
+        # Resizes and crops also run on the stacked frames of a clip, frames are already RGB
+        geometry = [t for t in transforms[:-2] if getattr(t, "__name__", None) != "_convert_to_rgb"]
+        if all(isinstance(t, (T.Resize, T.CenterCrop)) for t in geometry):
+            frames_transform = FramesTransform(tensor_transform=T.Compose(geometry))
+        else:
+            frames_transform = FramesTransform(image_transform=transform)
+
+        return BatchPreprocess(
+            transform, None, frames_transform, draft_size, 1 / 255, list(normalize.mean), list(normalize.std)
+        )
+
+    frames_transform = FramesTransform(image_transform=preprocess)
+    return BatchPreprocess(preprocess, None, frames_transform, draft_size, 1.0, [0.0, 0.0, 0.0], [1.0, 1.0, 1.0])
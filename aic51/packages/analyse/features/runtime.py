@@ -0,0 +1,161 @@
+import copy
+import re
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import torch
+
+import aic51.packages.constant as constant
+
+EXPORT_RUNTIMES = {
+    "torchscript": ".pt",
+    "onnx": ".onnx",
+}
+
+# Queries the text encoders are exported and checked with
+EXAMPLE_TEXTS = [
+    "a person riding a bicycle on the street",
+    "close-up of a news anchor in a studio",
+    "a red car parked next to a building at night",
+    "two people shaking hands",
+]
+
+
+def get_model_id(source: str, arch_name: str | None, pretrained_model: str | None) -> str:
+    model_id = "_".join(str(x) for x in [source, arch_name, pretrained_model] if x)
+    return re.sub(r"[^A-Za-z0-9._-]+", "-", model_id)
+
+
+def get_export_dir(source: str, arch_name: str | None, pretrained_model: str | None) -> Path:
+    # Features using the same model share its exported encoders
+    return Path.cwd() / constant.MODEL_DIR / get_model_id(source, arch_name, pretrained_model)
+
+
+def get_export_path(export_dir: Path, encoder_name: str, runtime: str) -> Path:
+    if runtime not in EXPORT_RUNTIMES:
+        raise RuntimeError(f"runtime={runtime} is invalid, expected one of {list(EXPORT_RUNTIMES.keys())}")
+    return export_dir / f"{encoder_name}{EXPORT_RUNTIMES[runtime]}"
+
+
+def _import_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise RuntimeError("onnxruntime is not installed, install it to use the onnx runtime")
+    return onnxruntime
+
+
+class EncoderModule(torch.nn.Module):
+    # Wraps an encoding method of a model so that it can be traced
+    def __init__(self, model: torch.nn.Module, method_name: str):
+        super().__init__()
+        self.model = model
+        self._method_name = method_name
+
+    def forward(self, *inputs):
+        return getattr(self.model, self._method_name)(*inputs)
+
+
+def export_encoder(
+    module: torch.nn.Module, example_inputs: tuple[torch.Tensor, ...], export_path: Path, runtime: str, quantize: bool
+):
+    export_path.parent.mkdir(parents=True, exist_ok=True)
+    # The model may be shared with other extractors, a copy of it is moved to the CPU and quantized
+    module = copy.deepcopy(module).cpu().eval()
+    example_inputs = tuple(x.cpu() for x in example_inputs)
+
+    if runtime == "torchscript":
+        # Dynamic quantization stores the weights of linear layers in int8 and runs them with int8 kernels on CPU
+        if quantize:
+            module = torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+        with torch.no_grad():
+            traced = torch.jit.trace(module, example_inputs, check_trace=False)
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+        traced.save(str(export_path))
+    elif runtime == "onnx":
+        input_names = [f"input_{i}" for i in range(len(example_inputs))]
+        dynamic_axes = {name: {0: "batch"} for name in input_names + ["features"]}
+        onnx_path = export_path.with_name(f".{export_path.name}.fp32") if quantize else export_path
+
+        with torch.no_grad():
+            torch.onnx.export(
+                module,
+                example_inputs,
+                str(onnx_path),
+                input_names=input_names,
+                output_names=["features"],
+                dynamic_axes=dynamic_axes,
+                opset_version=17,
+            )
+
+        if quantize:
+            _import_onnxruntime()
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantize_dynamic(str(onnx_path), str(export_path), weight_type=QuantType.QInt8)
+            onnx_path.unlink()
+    else:
+        raise RuntimeError(f"runtime={runtime} is invalid, expected one of {list(EXPORT_RUNTIMES.keys())}")
+
+
+class ExportedEncoder:
+    # Runs an exported encoder with the same inputs and outputs as the eager one
+    def __init__(self, export_path: Path, runtime: str, device: str | torch.device = "cpu"):
+        if not export_path.exists():
+            raise RuntimeError(f"{export_path} does not exist, export the model with the export command first")
+
+        self._runtime = runtime
+        self._device = torch.device(device)
+        if runtime == "torchscript":
+            self._module = torch.jit.load(str(export_path), map_location=self._device)
+        elif runtime == "onnx":
+            onnxruntime = _import_onnxruntime()
+            self._session = onnxruntime.InferenceSession(str(export_path), providers=["CPUExecutionProvider"])
+            self._input_names = [i.name for i in self._session.get_inputs()]
+        else:
+            raise RuntimeError(f"runtime={runtime} is invalid, expected one of {list(EXPORT_RUNTIMES.keys())}")
+
+    def __call__(self, *inputs: torch.Tensor) -> torch.Tensor:
+        if self._runtime == "torchscript":
+            return self._module(*inputs)
+
+        feed = {name: x.cpu().numpy() for name, x in zip(self._input_names, inputs)}
+        features = self._session.run(None, feed)[0]
+        return torch.from_numpy(features).to(inputs[0].device)
+
+    def to(self, device: str | torch.device):
+        self._device = torch.device(device)
+        if self._runtime == "torchscript":
+            self._module.to(self._device)
+        return self
+
+
+def load_encoder(
+    module: EncoderModule, export_dir: Path, encoder_name: str, runtime: str, device: str | torch.device
+) -> EncoderModule | ExportedEncoder:
+    # "torch" runs the eager model, other runtimes load the encoder exported by the export command and the model of
+    # the module is not loaded
+    if runtime == "torch":
+        return module
+    return ExportedEncoder(get_export_path(export_dir, encoder_name, runtime), runtime, device)
+
+
+def check_parity(
+    eager: Callable, exported: Callable, example_inputs: tuple[torch.Tensor, ...], batch_size: int = 8
+) -> tuple[float, float]:
+    # Mean and lowest cosine similarity between the eager and the exported embeddings of the same inputs
+    similarities = []
+    with torch.no_grad():
+        for i in range(0, len(example_inputs[0]), batch_size):
+            batch_inputs = tuple(x[i : i + batch_size] for x in example_inputs)
+            eager_features = eager(*batch_inputs).float().cpu().numpy()
+            exported_features = exported(*batch_inputs).float().cpu().numpy()
+
+            eager_features /= np.linalg.norm(eager_features, axis=-1, keepdims=True)
+            exported_features /= np.linalg.norm(exported_features, axis=-1, keepdims=True)
+            similarities.append((eager_features * exported_features).sum(axis=-1))
+
+    similarities = np.concatenate(similarities)
+    return float(similarities.mean()), float(similarities.min())
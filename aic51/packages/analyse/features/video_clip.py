@@ -2,17 +2,20 @@ from pathlib import Path
 from typing import Any, Callable, Literal, Optional
 
 import numpy as np
-import open_clip
 import torch
 from PIL import Image
 from torch.utils.data import DataLoader
-from transformers import AutoModel, AutoProcessor
 
 import aic51.packages.constant as constant
-from aic51.packages.analyse.datasets import VideoDataset
+from aic51.packages.analyse.datasets import VideoDataset, sample_frame_indices
 from aic51.packages.config import GlobalConfig
+from aic51.packages.media import Clip
 
-from .feature_extractor import FeatureExtractor, FeatureExtractorFactory
+from .feature_extractor import FeatureExtractor, FeatureExtractorFactory, FeatureOutput
+from .frame_cache import FrameEmbeddingCache
+from .models import SharedModel
+from .preprocess import get_hf_batch_preprocess, get_open_clip_batch_preprocess
+from .runtime import EXAMPLE_TEXTS, EncoderModule, get_export_dir, load_encoder
 
 
 @FeatureExtractorFactory.register("video_clip")
@@ -32,21 +35,60 @@ class VideoCLIP(FeatureExtractor):
         else:
             raise RuntimeError(f"CLIP: source={source} is invalid")
 
+    def _can_pool_frames(self, clips: list[Any], keys: Optional[list[Any]]) -> bool:
+        return self._frame_cache is not None and keys is not None and all(isinstance(c, Clip) for c in clips)
 
-class HFProcessorWrapper:
-    def __init__(self, processor):
-        self._processor = processor
+    def _get_pooled_features(
+        self,
+        clips: list[Clip],
+        keys: list[Any],
+        callback: Optional[Callable] = None,
+        sink: Optional[Callable] = None,
+    ) -> np.ndarray:
+        # Video features are the mean of the embeddings of the sampled frames of their clip, frames shared with other
+        # clips are encoded once
+        output = FeatureOutput(len(clips), sink)
+        num_batches = (len(clips) + self._batch_size - 1) // self._batch_size
 
-    def __call__(self, images):
-        processed_data = self._processor(images=[images], return_tensors="pt")
-        video_data = processed_data["pixel_values"]
+        with torch.no_grad():
+            if callback:
+                callback(self, 0, num_batches, output.features)
+
+            for i, start in enumerate(range(0, len(clips), self._batch_size)):
+                batch_frames = []
+                for clip, (video_id, _) in zip(clips[start : start + self._batch_size], keys[start:]):
+                    for j in sample_frame_indices(len(clip)):
+                        batch_frames.append(((video_id, int(clip.frame_ids[j])), clip, j))
+
+                frame_keys = [frame_key for frame_key, _, _ in batch_frames]
+                embeddings = dict(zip(frame_keys, self._frame_cache.get(self._model_id, frame_keys)))
+
+                # Frames are keyed by their grid id, only the ones without an embedding are read from the store
+                missing = {}
+                for frame_key, clip, j in batch_frames:
+                    if embeddings[frame_key] is None and frame_key not in missing:
+                        missing[frame_key] = clip.get_frame(j)
+
+                if len(missing) > 0:
+                    # Clip frames are stored in BGR order
+                    frames = [np.ascontiguousarray(frame[None, ..., ::-1]) for frame in missing.values()]
+                    data = torch.cat([self._batch_preprocess.frames_transform(frame) for frame in frames], dim=0)
+                    data = self._batch_preprocess.normalize(data, self._device)
+                    frame_features = self._image_encoder(data).float().cpu().numpy()
+
+                    self._frame_cache.put(self._model_id, list(missing.keys()), frame_features)
+                    embeddings.update(zip(missing.keys(), frame_features))
+
+                n = constant.NUM_FRAMES_VIDEO_FEATURE
+                batch_features = np.stack([embeddings[frame_key] for frame_key in frame_keys], axis=0)
+                batch_features = batch_features.reshape(-1, n, batch_features.shape[-1]).mean(axis=1)
+                batch_features /= np.linalg.norm(batch_features, axis=-1, keepdims=True)
+                output.write(batch_features)
 
-        if video_data.shape[0] < constant.NUM_FRAMES_VIDEO_FEATURE:
-            offset = constant.NUM_FRAMES_VIDEO_FEATURE - video_data.shape[0]
-            video_data = torch.cat([video_data, torch.zeros(offset, *video_data.shape[1:])], dim=0)
+                if callback:
+                    callback(self, i + 1, num_batches, output.features)
 
-        processed_data["pixel_values"] = video_data
-        return processed_data
+        return output.features
 
 
 class VideoHFCLIP(VideoCLIP):
@@ -60,13 +102,16 @@ class VideoHFCLIP(VideoCLIP):
         name: str = "clip",
         batch_size: int = 1,
         device: torch.device = torch.device("cpu"),
+        runtime: str = "torch",
+        frame_cache: Optional[FrameEmbeddingCache] = None,
         *args,
         **kwargs,
     ):
-        self._model = AutoModel.from_pretrained(pretrained_model)
-        self._processor = AutoProcessor.from_pretrained(pretrained_model)
-
-        self._model.eval()
+        # The model is loaded or shared when the extractor is moved to its device
+        self._shared_model = SharedModel("hf", None, pretrained_model, weights=runtime == "torch")
+        self._runtime = runtime
+        self._frame_cache = frame_cache
+        self._model_id = self._shared_model.model_id
 
         super().__init__(name, batch_size, device)
 
@@ -74,9 +119,13 @@ class VideoHFCLIP(VideoCLIP):
         self,
         images: list[Path | str] | np.ndarray | torch.Tensor | list[Image.Image],
         callback: Optional[Callable] = None,
+        sink: Optional[Callable] = None,
+        keys: Optional[list[Any]] = None,
     ) -> np.ndarray:
+        if self._can_pool_frames(images, keys):
+            return self._get_pooled_features(images, keys, callback, sink)
 
-        dataset = VideoDataset(images, HFProcessorWrapper(self._processor))
+        dataset = VideoDataset(images, self._batch_preprocess.frames_transform)
 
         dataloader = DataLoader(
             dataset=dataset,
@@ -87,30 +136,27 @@ class VideoHFCLIP(VideoCLIP):
             pin_memory=(True if GlobalConfig.get("analyse", "pin_memory") else False),
         )
 
-        image_features = torch.Tensor(0).to(self._device)
+        output = FeatureOutput(len(dataset), sink)
         num_batches = len(dataloader)
 
         with torch.no_grad():
             if callback:
-                callback(self, 0, num_batches, image_features)
+                callback(self, 0, num_batches, output.features)
 
             for i, data in enumerate(dataloader):
-                data = data.to(self._device)
-                video_data = data["pixel_values"]
-                b, n, c, h, w = video_data.shape
-                data["pixel_values"] = video_data.reshape(b * n, c, h, w)
-
-                batch_features = self._model.get_image_features(**data)
+                data = self._batch_preprocess.normalize(data, self._device)
+                b, n, c, h, w = data.shape
+                batch_features = self._image_encoder(data.reshape(b * n, c, h, w))
                 batch_features = batch_features.reshape(b, n, -1)
                 batch_features = batch_features.mean(dim=1)
 
-                image_features = torch.cat([image_features, batch_features])
+                batch_features /= batch_features.norm(dim=-1, keepdim=True)
+                output.write(batch_features)
 
                 if callback:
-                    callback(self, i + 1, num_batches, image_features)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
+                    callback(self, i + 1, num_batches, output.features)
 
-        return image_features.cpu().numpy()
+        return output.features
 
     def get_text_features(self, texts: list[str] | str | np.ndarray, callback: Optional[Callable] = None) -> Any:
         if isinstance(texts, np.ndarray):
@@ -118,29 +164,51 @@ class VideoHFCLIP(VideoCLIP):
         if isinstance(texts, str):
             texts = [texts]
 
-        tokenized_input = self._processor(text=texts, return_tensors="pt", padding=True).to(self._device)
+        tokenized_input = self._tokenize(texts).to(self._device)
         with torch.no_grad():
-            text_features = self._model.get_text_features(**tokenized_input)
+            text_features = self._text_encoder(*tokenized_input.values())
             text_features /= text_features.norm(dim=-1, keepdim=True)
         return text_features.cpu().numpy()
 
     def to(self, device: str | torch.device):
         self._device = torch.device(device)
-        self._model.to(self._device)
-
-
-class OpenCLIPPreprocessWrapper:
-    def __init__(self, preprocess):
-        self._preprocess = preprocess
-
-    def __call__(self, images):
-        video_data = torch.stack([self._preprocess(i) for i in images], dim=0)
-
-        if video_data.shape[0] < constant.NUM_FRAMES_VIDEO_FEATURE:
-            offset = constant.NUM_FRAMES_VIDEO_FEATURE - video_data.shape[0]
-            video_data = torch.cat([video_data, torch.zeros(offset, *video_data.shape[1:])], dim=0)
-
-        return video_data
+        if self._shared_model.to(self._device):
+            self._model, self._processor = self._shared_model.components
+            self._batch_preprocess = get_hf_batch_preprocess(self._processor)
+
+            export_dir = get_export_dir("hf", None, self._shared_model.pretrained_model)
+            self._image_encoder = load_encoder(
+                EncoderModule(self._model, "get_image_features"), export_dir, "image", self._runtime, self._device
+            )
+            self._text_encoder = load_encoder(
+                EncoderModule(self._model, "get_text_features"), export_dir, "text", self._runtime, self._device
+            )
+        self._batch_preprocess.to(self._device)
+
+    def close(self):
+        self._shared_model.release()
+
+    def get_encoders(
+        self, images: Optional[list[Image.Image]] = None
+    ) -> dict[str, tuple[EncoderModule, tuple[torch.Tensor, ...]]]:
+        # Eager encoders with example inputs to export and check them, images are random without samples
+        if self._runtime != "torch":
+            raise RuntimeError(f"{self.name}: encoders are already exported to {self._runtime}")
+
+        if images is None:
+            images = [Image.fromarray(np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8)) for _ in EXAMPLE_TEXTS]
+        pixel_values = self._processor(images=images, return_tensors="pt")["pixel_values"]
+        tokenized_input = self._tokenize(EXAMPLE_TEXTS, padding="max_length")
+        return {
+            "image": (self._image_encoder, (pixel_values,)),
+            "text": (self._text_encoder, tuple(tokenized_input.values())),
+        }
+
+    def _tokenize(self, texts: list[str], padding: bool | str = True):
+        # Exported text encoders are traced with inputs padded to the maximum length
+        if self._runtime != "torch":
+            padding = "max_length"
+        return self._processor(text=texts, return_tensors="pt", padding=padding)
 
 
 class VideoOpenCLIP(VideoCLIP):
@@ -155,17 +223,16 @@ class VideoOpenCLIP(VideoCLIP):
         name: str = "clip",
         batch_size: int = 1,
         device: torch.device = torch.device("cpu"),
+        runtime: str = "torch",
+        frame_cache: Optional[FrameEmbeddingCache] = None,
         *args,
         **kwargs,
     ):
-        model, _, preprocess = open_clip.create_model_and_transforms(arch_name, pretrained_model)
-        tokenizer = open_clip.get_tokenizer(arch_name)
-
-        self._model = model
-        self._preprocess = preprocess
-        self._tokenizer = tokenizer
-
-        self._model.eval()
+        # The model is loaded or shared when the extractor is moved to its device
+        self._shared_model = SharedModel("open_clip", arch_name, pretrained_model, weights=runtime == "torch")
+        self._runtime = runtime
+        self._frame_cache = frame_cache
+        self._model_id = self._shared_model.model_id
 
         super().__init__(name, batch_size, device)
 
@@ -173,9 +240,13 @@ class VideoOpenCLIP(VideoCLIP):
         self,
         images: list[Path | str] | np.ndarray | torch.Tensor | list[Image.Image],
         callback: Optional[Callable] = None,
+        sink: Optional[Callable] = None,
+        keys: Optional[list[Any]] = None,
     ) -> np.ndarray:
+        if self._can_pool_frames(images, keys):
+            return self._get_pooled_features(images, keys, callback, sink)
 
-        dataset = VideoDataset(images, OpenCLIPPreprocessWrapper(self._preprocess))
+        dataset = VideoDataset(images, self._batch_preprocess.frames_transform)
 
         dataloader = DataLoader(
             dataset=dataset,
@@ -186,29 +257,28 @@ class VideoOpenCLIP(VideoCLIP):
             pin_memory=(True if GlobalConfig.get("analyse", "pin_memory") else False),
         )
 
-        image_features = torch.Tensor(0).to(self._device)
+        output = FeatureOutput(len(dataset), sink)
         num_batches = len(dataloader)
 
         with torch.no_grad():
             if callback:
-                callback(self, 0, num_batches, image_features)
+                callback(self, 0, num_batches, output.features)
 
             for i, data in enumerate(dataloader):
-                data = data.to(self._device)
+                data = self._batch_preprocess.normalize(data, self._device)
                 b, n, c, h, w = data.shape
                 data = data.reshape(b * n, c, h, w)
-                batch_features = self._model.encode_image(data)
+                batch_features = self._image_encoder(data)
                 batch_features = batch_features.reshape(b, n, -1)
                 batch_features = batch_features.mean(dim=1)
 
-                image_features = torch.cat([image_features, batch_features])
+                batch_features /= batch_features.norm(dim=-1, keepdim=True)
+                output.write(batch_features)
 
                 if callback:
-                    callback(self, i + 1, num_batches, image_features)
-
-            image_features /= image_features.norm(dim=-1, keepdim=True)
+                    callback(self, i + 1, num_batches, output.features)
 
-        return image_features.cpu().numpy()
+        return output.features
 
     def get_text_features(self, texts: list[str] | str | np.ndarray, callback: Optional[Callable] = None) -> Any:
         if isinstance(texts, np.ndarray):
@@ -218,11 +288,41 @@ class VideoOpenCLIP(VideoCLIP):
 
         tokenized_input = self._tokenizer(texts).to(self._device)
         with torch.no_grad():
-            text_features = self._model.encode_text(tokenized_input)
+            text_features = self._text_encoder(tokenized_input)
             text_features /= text_features.norm(dim=-1, keepdim=True)
 
         return text_features.cpu().numpy()
 
     def to(self, device: str | torch.device):
         self._device = torch.device(device)
-        self._model.to(self._device)
+        if self._shared_model.to(self._device):
+            self._model, self._preprocess, self._tokenizer = self._shared_model.components
+            self._batch_preprocess = get_open_clip_batch_preprocess(self._preprocess)
+
+            shared_model = self._shared_model
+            export_dir = get_export_dir("open_clip", shared_model.arch_name, shared_model.pretrained_model)
+            self._image_encoder = load_encoder(
+                EncoderModule(self._model, "encode_image"), export_dir, "image", self._runtime, self._device
+            )
+            self._text_encoder = load_encoder(
+                EncoderModule(self._model, "encode_text"), export_dir, "text", self._runtime, self._device
+            )
+        self._batch_preprocess.to(self._device)
+
+    def close(self):
+        self._shared_model.release()
+
+    def get_encoders(
+        self, images: Optional[list[Image.Image]] = None
+    ) -> dict[str, tuple[EncoderModule, tuple[torch.Tensor, ...]]]:
+        # Eager encoders with example inputs to export and check them, images are random without samples
+        if self._runtime != "torch":
+            raise RuntimeError(f"{self.name}: encoders are already exported to {self._runtime}")
+
+        if images is None:
+            images = [Image.fromarray(np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8)) for _ in EXAMPLE_TEXTS]
+        pixel_values = torch.stack([self._preprocess(image) for image in images], dim=0)
+        return {
+            "image": (self._image_encoder, (pixel_values,)),
+            "text": (self._text_encoder, (self._tokenizer(EXAMPLE_TEXTS),)),
+        }
@@ -0,0 +1 @@
+from .processors import AnalyseProcessor
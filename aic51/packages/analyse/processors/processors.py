@@ -1,21 +1,224 @@
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from math import lcm
 from pathlib import Path
-from typing import Optional, Callable
+from queue import Empty, Full, Queue
+from threading import Lock
+from typing import Any, Callable, Optional
 
 import numpy as np
 import torch
-from analyse.features.feature_extractor import FeatureExtractor
 from PIL import Image
 
+import aic51.packages.constant as constant
+from aic51.packages.analyse.features import FeatureExtractor
+from aic51.packages.logger import logger
+from aic51.packages.media import open_image
+
 
 class AnalyseProcessor:
-    def __init__(self, extractors: list[FeatureExtractor]):
+    # Keyframes are decoded once per chunk and draft size and shared by every extractor requiring them, extractors
+    # with an image transform get them transformed in the decode threads, as one tensor per chunk, so that no data
+    # loader is started for each chunk. Other inputs are passed to their extractor as they are. Each extractor runs in
+    # its own thread so that models and OCR processes overlap
+    def __init__(
+        self,
+        extractors: list[FeatureExtractor],
+        chunk_size: int = 256,
+        decode_workers: int = 4,
+        num_workers: Optional[dict[str, int]] = None,
+        max_pending_chunks: int = 2,
+    ):
         self._extractors = extractors
+        self._decode_workers = max(1, decode_workers)
+        self._num_workers = num_workers or {}
+        self._max_pending_chunks = max(1, max_pending_chunks)
+
+        # Chunks are split at batch boundaries of every extractor so that batches are the same as without chunks
+        batch_size = lcm(*[max(1, getattr(e, "_batch_size", 1)) for e in extractors]) if len(extractors) > 0 else 1
+        self._chunk_size = max(1, chunk_size // batch_size) * batch_size
+
+        self._stats_lock = Lock()
+        self._stats = {extractor.name: [0, 0.0] for extractor in extractors}  # inputs, busy seconds
+
+    @property
+    def extractors(self):
+        return self._extractors
 
     def process(
         self,
-        images: list[Path | str] | np.ndarray | torch.Tensor | list[Image.Image],
+        inputs: dict[str, tuple[list[Any], list[Any]]],
         callback: Optional[Callable] = None,
-    ):
-        features = []
+        sink: Optional[Callable] = None,
+    ) -> dict[str, np.ndarray]:
+        # inputs maps the name of each extractor to its keys and input files, the keys of keyframe inputs identify
+        # the decoded frames. sink(extractor, keys, batch_features) receives every batch as soon as it is computed,
+        # features are only returned without a sink
+        shared_extractors = []
+        other_extractors = []
         for extractor in self._extractors:
-            feature = extractor.get_features(images, callback)
+            if extractor.name not in inputs or len(inputs[extractor.name][0]) == 0:
+                continue
+            if extractor.require_input() == constant.KEYFRAME_DIR:
+                shared_extractors.append(extractor)
+            else:
+                other_extractors.append(extractor)
+
+        sources = {}
+        keys_sets = {}
+        draft_sizes = {}
+        transforms = {}
+        for extractor in shared_extractors:
+            sources.update(zip(*inputs[extractor.name]))
+            keys_sets[extractor.name] = set(inputs[extractor.name][0])
+            draft_sizes[extractor.name] = extractor.get_draft_size()
+            transforms[extractor.name] = extractor.get_image_transform()
+        frame_ids = sorted(sources.keys())
+        chunks = [frame_ids[i : i + self._chunk_size] for i in range(0, len(frame_ids), self._chunk_size)]
+
+        num_steps = len(chunks) * len(shared_extractors) + len(other_extractors)
+        completed_steps = 0
+        progress_lock = Lock()
+
+        def advance():
+            nonlocal completed_steps
+            with progress_lock:
+                completed_steps += 1
+                if callback:
+                    callback(self, completed_steps, num_steps)
+
+        if callback:
+            callback(self, 0, num_steps)
+
+        features = {extractor.name: [] for extractor in shared_extractors}
+        queues = {extractor.name: Queue(self._max_pending_chunks) for extractor in shared_extractors}
+
+        def run_shared_extractor(extractor: FeatureExtractor):
+            self._set_num_workers(extractor)
+            while (images := queues[extractor.name].get()) is not None:
+                keys = [k for k in images if k in keys_sets[extractor.name]]
+                if len(keys) > 0:
+                    extractor_inputs = [images[k] for k in keys]
+                    if transforms[extractor.name] is not None:
+                        extractor_inputs = torch.stack(extractor_inputs, dim=0)
+                    res = self._get_features(extractor, keys, extractor_inputs, sink)
+                    if sink is None:
+                        features[extractor.name].append(res)
+                advance()
+
+        def run_other_extractor(extractor: FeatureExtractor):
+            self._set_num_workers(extractor)
+            res = self._get_features(extractor, *inputs[extractor.name], sink)
+            advance()
+            return res
+
+        with (
+            ThreadPoolExecutor(self._decode_workers) as decode_executor,
+            ThreadPoolExecutor(max(1, len(shared_extractors) + len(other_extractors))) as extractor_executor,
+        ):
+            other_futures = {e.name: extractor_executor.submit(run_other_extractor, e) for e in other_extractors}
+            shared_futures = {e.name: extractor_executor.submit(run_shared_extractor, e) for e in shared_extractors}
+
+            try:
+                for chunk in chunks + [None]:
+                    decoded = {}
+                    transformed = {}
+                    if chunk is not None:
+                        # Extractors with the same draft size share the same decoded images
+                        for draft_size in set(draft_sizes.values()):
+                            images = decode_executor.map(
+                                self._decode_image, [sources[k] for k in chunk], [draft_size] * len(chunk)
+                            )
+                            decoded[draft_size] = dict(zip(chunk, images))
+
+                        # Only the keyframes of an extractor are transformed for it
+                        for name, transform in transforms.items():
+                            if transform is None:
+                                continue
+                            images = decoded[draft_sizes[name]]
+                            keys = [k for k in chunk if k in keys_sets[name]]
+                            transformed_images = decode_executor.map(transform, [images[k] for k in keys])
+                            transformed[name] = dict(zip(keys, transformed_images))
+                    # Decoding waits for the slowest extractor so that at most max_pending_chunks chunks are held
+                    for name, queue in queues.items():
+                        item = transformed.get(name, decoded.get(draft_sizes[name]))
+                        self._put(queue, item, shared_futures[name])
+            except BaseException:
+                # Extractors waiting for chunks are stopped on errors and interrupts alike, the error is raised again
+                for queue in queues.values():
+                    self._drain(queue)
+                raise
+
+            res = {name: future.result() for name, future in other_futures.items()}
+            for future in shared_futures.values():
+                future.result()
+
+        if sink is not None:
+            return {}
+
+        # Features were computed in frame order, they are returned in the order of the keys
+        for extractor in shared_extractors:
+            keys = inputs[extractor.name][0]
+            positions = {k: i for i, k in enumerate(sorted(set(keys)))}
+            res[extractor.name] = np.concatenate(features[extractor.name])[[positions[k] for k in keys]]
+
+        return res
+
+    def get_throughput(self) -> dict[str, float]:
+        # Inputs per second spent in each extractor since the processor was created
+        with self._stats_lock:
+            return {name: (n / busy if busy > 0 else 0.0) for name, (n, busy) in self._stats.items()}
+
+    def log_throughput(self):
+        with self._stats_lock:
+            stats = {name: tuple(stat) for name, stat in self._stats.items()}
+
+        for name, (n, busy) in stats.items():
+            if n > 0:
+                logger.info(f"analyse: {name} processed {n} inputs in {busy:.2f}s ({n / busy:.2f} inputs/s)")
+
+    def _get_features(self, extractor: FeatureExtractor, keys: list[Any], images: list[Any], sink: Optional[Callable]):
+        def extractor_sink(start: int, batch_features: np.ndarray):
+            if sink:
+                sink(extractor, keys[start : start + len(batch_features)], batch_features)
+
+        start_time = time.perf_counter()
+        res = extractor.get_features(images, sink=extractor_sink, keys=keys)
+        busy = time.perf_counter() - start_time
+
+        with self._stats_lock:
+            self._stats[extractor.name][0] += len(images)
+            self._stats[extractor.name][1] += busy
+
+        return res
+
+    def _set_num_workers(self, extractor: FeatureExtractor):
+        num_workers = self._num_workers.get(extractor.name)
+        if num_workers:
+            extractor.set_num_workers(num_workers)
+
+    def _put(self, queue: Queue, item: Any, future: Future):
+        # An extractor that failed stops reading its queue, its error is raised instead of waiting forever
+        while True:
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                if future.done():
+                    future.result()
+                    raise RuntimeError("Extractor stopped before the end of its inputs")
+
+    def _drain(self, queue: Queue):
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            queue.put_nowait(None)
+
+    def _decode_image(
+        self, image: Path | str | np.ndarray | Image.Image, draft_size: Optional[tuple[int, int]] = None
+    ) -> Image.Image:
+        if not isinstance(image, Image.Image):
+            image = open_image(image, draft_size)
+        image.load()
+        return image
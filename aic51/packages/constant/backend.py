@@ -10,8 +10,10 @@ TARGET_FEATURES_ENDPOINT = "/api/target_features"
 STREAM_FILE_ENDPOINT = "/api/stream"
 FILE_ENDPOINT = "/api/files"
 FILE_INFO_ENDPOINT = "/api/files/info"
+STORYBOARD_ENDPOINT = "/api/storyboards"
 
 HEALTH_ENDPOINT = "/api/health"
+STORYBOARD_HEALTH_ENDPOINT = "/api/health/storyboards"
 
 MESSAGE_KEY = "msg"
 TARGET_FEATURES_KEY = "target_features"
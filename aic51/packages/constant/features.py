@@ -1,5 +1,13 @@
 NUM_FRAMES_VIDEO_FEATURE = 8
 
 FPS_KEY = "frame_rate"
+DURATION_KEY = "duration"
+WIDTH_KEY = "width"
+HEIGHT_KEY = "height"
+NUM_FRAMES_KEY = "num_frames"
+KEYFRAMES_KEY = "keyframes"
+SOURCE_KEYFRAMES_KEY = "source_keyframes"
+MTIME_KEY = "mtime"
+SIZE_KEY = "size"
 
 TEMPORAL_QUEUE_SIZE = 10000
@@ -5,16 +5,21 @@ DATA_DIR = f"data"
 
 KEYFRAME_DIR = f"{DATA_DIR}/keyframes"
 THUMBNAIL_DIR = f"{DATA_DIR}/thumbnails"
+STORYBOARD_DIR = f"{DATA_DIR}/storyboards"
 VIDEO_DIR = f"{DATA_DIR}/videos"
 VIDEO_CLIP_DIR = f"{DATA_DIR}/video_clips"
 AUDIO_DIR = f"{DATA_DIR}/audio"
 AUDIO_CLIP_DIR = f"{DATA_DIR}/audio_clips"
 VIDEO_INFO_DIR = f"{DATA_DIR}/video_info"
+DUPLICATE_DIR = f"{DATA_DIR}/duplicates"
+MANIFEST_PATH = f"{DATA_DIR}/manifest.json"
 
 FEATURE_DIR = "features"
+MODEL_DIR = "models"
 
 FRONTEND_DIST_DIR = ".web"
 
 VIDEO_EXTENSION = ".mp4"
 VIDEO_MEDIA_TYPE = "video/mp4"
 IMAGE_EXTENSION = ".jpg"
+IMAGE_MEDIA_TYPE = "image/jpeg"
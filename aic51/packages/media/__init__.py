@@ -0,0 +1,22 @@
+from .audio import AudioClipStore, open_wav_memmap, save_audio_clips
+from .buffer import FrameRingBuffer
+from .clips import Clip, ClipStore, ClipWriter, merge_clip_stores
+from .dedup import DuplicateFilter, dhash, find_duplicates, get_scene_ends, load_duplicates, save_duplicates
+from .images import (
+    DirectoryImageStore,
+    DirectoryImageStoreWriter,
+    ImageStore,
+    PackedImageStore,
+    PackedImageStoreWriter,
+    create_image_store_writer,
+    open_image,
+    open_image_store,
+    remove_images,
+)
+from .ingest import FFmpegIngest
+from .keyframes import iter_keyframe_ids, split_chunks
+from .probe import load_media_info, probe_has_audio, probe_keyframes, probe_media_info, probe_stream, save_media_info
+from .reader import read_frames
+from .selectors import IFrameSelector, KeyframeSelector, KeyframeSelectorFactory, SceneCutSelector
+from .storyboard import get_storyboard_sheet_path, load_storyboard_index, save_storyboard
+from .writer import ImageWriter
@@ -0,0 +1,100 @@
+import json
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+
+WAV_DTYPES = {
+    8: np.uint8,
+    16: np.int16,
+    32: np.int32,
+}
+
+
+def open_wav_memmap(wav_path: Path) -> tuple[np.memmap, int]:
+    # Samples are mapped from the data chunk of the RIFF file, so nothing is read before it is sliced
+    with open(wav_path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise ValueError(f"{wav_path}: Not a WAV file")
+
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"{wav_path}: No data chunk")
+
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                fmt = struct.unpack("<HHIIHH", f.read(16))
+                f.seek(chunk_size - 16 + (chunk_size & 1), os.SEEK_CUR)
+            elif chunk_id == b"data":
+                data_offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+    if fmt is None:
+        raise ValueError(f"{wav_path}: No fmt chunk")
+
+    _, num_channels, sample_rate, _, block_align, bits_per_sample = fmt
+    if bits_per_sample not in WAV_DTYPES:
+        raise ValueError(f"{wav_path}: {bits_per_sample}-bit samples are not supported")
+
+    # The size in the header is not reliable for streamed files
+    data_size = min(chunk_size, wav_path.stat().st_size - data_offset)
+    num_frames = data_size // block_align
+
+    data = np.memmap(
+        wav_path,
+        dtype=WAV_DTYPES[bits_per_sample],
+        mode="r",
+        offset=data_offset,
+        shape=(num_frames, num_channels),
+    )
+    return data, sample_rate
+
+
+def save_audio_clips(index_path: Path, sample_rate: int, clips: dict[int, tuple[int, int]]):
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+
+    index = {
+        "sample_rate": sample_rate,
+        "clips": {str(frame_id): [start, end] for frame_id, (start, end) in clips.items()},
+    }
+    tmp_path = index_path.with_name(f".{index_path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+class AudioClipStore:
+    # Audio clips are [start, end) sample ranges of the WAV of the video
+    def __init__(self, index_path: Path, audio_path: Path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+        self._clips = {int(frame_id): tuple(r) for frame_id, r in index["clips"].items()}
+        self._audio_path = audio_path
+        self._data = None
+        self.sample_rate = index["sample_rate"]
+
+    def __len__(self):
+        return len(self._clips)
+
+    def __contains__(self, frame_id: int):
+        return frame_id in self._clips
+
+    def keys(self):
+        return sorted(self._clips.keys())
+
+    def get_range(self, frame_id: int) -> tuple[int, int]:
+        return self._clips[frame_id]
+
+    def get(self, frame_id: int) -> np.ndarray:
+        if self._data is None:
+            self._data, _ = open_wav_memmap(self._audio_path)
+
+        start, end = self._clips[frame_id]
+        return self._data[start:end]
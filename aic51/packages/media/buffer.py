@@ -0,0 +1,49 @@
+import numpy as np
+
+
+class FrameRingBuffer:
+    def __init__(self, capacity: int, frame_shape: tuple, dtype=np.uint8, start_index: int = 0):
+        if capacity <= 0:
+            raise ValueError(f"FrameRingBuffer: capacity={capacity} must be positive")
+
+        self._capacity = capacity
+        self._frames = np.empty((capacity, *frame_shape), dtype=dtype)
+        self._start = start_index  # absolute index of the first frame pushed
+        self._end = start_index  # absolute index of the next frame to be pushed
+
+    @staticmethod
+    def estimate_nbytes(capacity: int, frame_shape: tuple, dtype=np.uint8) -> int:
+        return capacity * int(np.prod(frame_shape)) * np.dtype(dtype).itemsize
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def nbytes(self):
+        return self._frames.nbytes
+
+    @property
+    def first_index(self):
+        return max(self._start, self._end - self._capacity)
+
+    @property
+    def last_index(self):
+        return self._end - 1
+
+    def __len__(self):
+        return min(self._end - self._start, self._capacity)
+
+    def __contains__(self, frame_index: int):
+        return self.first_index <= frame_index <= self.last_index
+
+    def push(self, frame: np.ndarray):
+        self._frames[self._end % self._capacity] = frame
+        self._end += 1
+
+    def get(self, frame_index: int) -> np.ndarray:
+        if frame_index not in self:
+            raise IndexError(
+                f"FrameRingBuffer: frame {frame_index} is out of range [{self.first_index}, {self.last_index}]"
+            )
+        return self._frames[frame_index % self._capacity]
@@ -0,0 +1,163 @@
+import json
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+CLIP_STORE_PREFIX = "clips_"
+
+
+class Clip:
+    # Frames of a packed clip with their ids in the video, they are read from the frame array of the store by id so
+    # that clips sharing frames do not copy them
+    def __init__(self, frame_ids: list[int], clip_store: "ClipStore"):
+        self.frame_ids = frame_ids
+        self._clip_store = clip_store
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    def get_frame(self, index: int) -> np.ndarray:
+        # Read-only view of the frame array in BGR order
+        return self._clip_store.get_frame(self.frame_ids[index])
+
+
+class ClipWriter:
+    # Distinct clip frames are appended raw to one frame array, the index maps each keyframe to the rows of its frames.
+    # Both files are renamed in place once complete so that a failed writer never leaves a truncated store behind
+    def __init__(self, clips_dir: Path, name: str, max_size: int | None = None):
+        self._data_path = clips_dir / f"{CLIP_STORE_PREFIX}{name}.bin"
+        self._index_path = clips_dir / f"{CLIP_STORE_PREFIX}{name}.json"
+        self._tmp_data_path = clips_dir / f".{self._data_path.name}.tmp"
+        self._max_size = max_size
+        self._file = None
+        self._frame_shape = None
+        self._rows = {}
+        self._clips = {}
+
+    def __enter__(self):
+        self._data_path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self._tmp_data_path, "wb")
+        return self
+
+    def __exit__(self, exc_type, *args):
+        assert self._file is not None
+        self._file.close()
+
+        if exc_type is not None:
+            os.remove(self._tmp_data_path)
+            return
+
+        index = {
+            "frame_shape": self._frame_shape,
+            "frames": list(self._rows.keys()),
+            "clips": self._clips,
+        }
+        tmp_index_path = self._index_path.with_name(f".{self._index_path.name}.tmp")
+        with open(tmp_index_path, "w") as f:
+            json.dump(index, f)
+
+        os.replace(self._tmp_data_path, self._data_path)
+        os.replace(tmp_index_path, self._index_path)
+
+    def __contains__(self, frame_id: int):
+        return frame_id in self._rows
+
+    def write_frame(self, frame_id: int, frame: np.ndarray):
+        assert self._file is not None
+        if frame_id in self._rows:
+            return
+
+        # Frames are not stored larger than the input of the models reading them
+        h, w = frame.shape[:2]
+        if self._max_size is not None and min(h, w) > self._max_size:
+            scale = self._max_size / min(h, w)
+            frame = cv2.resize(frame, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+        if self._frame_shape is None:
+            self._frame_shape = list(frame.shape)
+        if list(frame.shape) != self._frame_shape:
+            raise ValueError(f"ClipWriter: frame shape {frame.shape} differs from {self._frame_shape}")
+
+        self._file.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        self._rows[frame_id] = len(self._rows)
+
+    def write_clip(self, frame_id: int, frame_ids: list[int]):
+        # Frames of the clip must be written first
+        self._clips[str(frame_id)] = [self._rows[i] for i in frame_ids]
+
+
+class ClipStore:
+    def __init__(self, clips_dir: Path):
+        self._frames = {}
+        self._clips = {}
+
+        for index_path in sorted(clips_dir.glob(f"{CLIP_STORE_PREFIX}*.json")):
+            with open(index_path, "r") as f:
+                index = json.load(f)
+
+            if len(index["frames"]) == 0:
+                continue
+
+            # Frames written by several stores are the same frame of the video, the first one is used
+            data = np.memmap(index_path.with_suffix(".bin"), dtype=np.uint8, mode="r")
+            data = data.reshape(-1, *index["frame_shape"])
+            for row, frame_id in enumerate(index["frames"]):
+                self._frames.setdefault(frame_id, (data, row))
+            for frame_id, rows in index["clips"].items():
+                self._clips[int(frame_id)] = [index["frames"][row] for row in rows]
+
+    @staticmethod
+    def exists(clips_dir: Path):
+        return clips_dir.exists() and any(clips_dir.glob(f"{CLIP_STORE_PREFIX}*.json"))
+
+    def __len__(self):
+        return len(self._clips)
+
+    def __contains__(self, frame_id: int):
+        return frame_id in self._clips
+
+    def keys(self):
+        return sorted(self._clips.keys())
+
+    def get_frame(self, frame_id: int) -> np.ndarray:
+        # Returned frames are a read-only view of the frame array in BGR order
+        data, row = self._frames[frame_id]
+        return data[row]
+
+    def get(self, frame_id: int) -> np.ndarray:
+        return np.stack([self.get_frame(i) for i in self._clips[frame_id]], axis=0)
+
+    def get_frame_ids(self, frame_id: int) -> list[int]:
+        return self._clips[frame_id]
+
+    def get_clip(self, frame_id: int) -> Clip:
+        return Clip(self.get_frame_ids(frame_id), self)
+
+
+def merge_clip_stores(clips_dir: Path, name: str, max_size: int | None = None, exclude: set[int] | None = None):
+    # Chunks of a video write their own stores, they are merged into one frame array per video where frames at the
+    # boundaries of chunks are stored once. Clips of excluded keyframes are dropped with the frames only they use
+    exclude = exclude or set()
+    index_paths = sorted(clips_dir.glob(f"{CLIP_STORE_PREFIX}*.json"))
+    if len(index_paths) == 0 or (len(index_paths) == 1 and len(exclude) == 0):
+        return
+
+    clip_store = ClipStore(clips_dir)
+    with ClipWriter(clips_dir, name, max_size) as clip_writer:
+        for frame_id in clip_store.keys():
+            if frame_id in exclude:
+                continue
+            frame_ids = clip_store.get_frame_ids(frame_id)
+            for i in frame_ids:
+                clip_writer.write_frame(i, clip_store.get_frame(i))
+            clip_writer.write_clip(frame_id, frame_ids)
+    del clip_store
+
+    merged_index_path = clips_dir / f"{CLIP_STORE_PREFIX}{name}.json"
+    for index_path in index_paths:
+        if index_path == merged_index_path:
+            continue
+        os.remove(index_path)
+        os.remove(index_path.with_suffix(".bin"))
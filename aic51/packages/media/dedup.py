@@ -0,0 +1,68 @@
+import json
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+def dhash(frame: np.ndarray, hash_size: int = 8) -> int:
+    # Difference hash: signs of the horizontal gradients of a tiny grayscale copy of the frame
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class DuplicateFilter:
+    # Drops frames whose hash is within max_distance bits of the last kept frame
+    def __init__(self, max_distance: int):
+        self._max_distance = max_distance
+        self._last_hash = None
+        self._last_frame_id = None
+        self.duplicates = {}  # dropped frame id -> kept frame id
+
+    def keep(self, frame_id: int, frame: np.ndarray) -> bool:
+        return self.keep_hash(frame_id, dhash(frame))
+
+    def keep_hash(self, frame_id: int, frame_hash: int) -> bool:
+        if self._last_hash is not None and (frame_hash ^ self._last_hash).bit_count() <= self._max_distance:
+            self.duplicates[frame_id] = self._last_frame_id
+            return False
+
+        self._last_hash = frame_hash
+        self._last_frame_id = frame_id
+        return True
+
+
+def find_duplicates(frame_hashes: dict[int, int], max_distance: int) -> dict[int, int]:
+    # Hashes of the frames of a whole video filtered in frame order, as one DuplicateFilter would have done
+    duplicate_filter = DuplicateFilter(max_distance)
+    for frame_id in sorted(frame_hashes.keys()):
+        duplicate_filter.keep_hash(frame_id, frame_hashes[frame_id])
+    return duplicate_filter.duplicates
+
+
+def save_duplicates(duplicates_path: Path, duplicates: dict[int, int]):
+    duplicates_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = duplicates_path.with_name(f".{duplicates_path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({str(k): v for k, v in sorted(duplicates.items())}, f)
+    os.replace(tmp_path, duplicates_path)
+
+
+def load_duplicates(duplicates_path: Path) -> dict[int, int]:
+    try:
+        with open(duplicates_path, "r") as f:
+            return {int(k): v for k, v in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+
+def get_scene_ends(duplicates: dict[int, int]) -> dict[int, int]:
+    # Last frame represented by each kept frame that has duplicates
+    scene_ends = {}
+    for dropped, kept in duplicates.items():
+        scene_ends[kept] = max(scene_ends.get(kept, kept), dropped)
+    return scene_ends
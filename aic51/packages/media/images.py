@@ -0,0 +1,195 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from io import BytesIO
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+from PIL import Image
+
+import aic51.packages.constant as constant
+
+IMAGE_STORE_PREFIX = "images_"
+
+
+def open_image(image: Path | str | np.ndarray, draft_size: tuple[int, int] | None = None) -> Image.Image:
+    # 1-D arrays are encoded images, like the buffers of cv2.imencode or the views of a packed image store
+    if isinstance(image, np.ndarray):
+        image = Image.open(BytesIO(memoryview(np.ascontiguousarray(image))))
+    else:
+        image = Image.open(image)
+
+    # JPEG images are decoded at the smallest DCT scale (1/2, 1/4 or 1/8) still covering draft_size
+    if draft_size is not None and image.format == "JPEG":
+        image.draft("RGB", draft_size)
+    return image
+
+
+class ImageStore(ABC):
+    @abstractmethod
+    def keys(self) -> list[int]:
+        pass
+
+    @abstractmethod
+    def __contains__(self, frame_id: int) -> bool:
+        pass
+
+    @abstractmethod
+    def get(self, frame_id: int) -> Path | np.ndarray:
+        pass
+
+    @abstractmethod
+    def read_bytes(self, frame_id: int) -> bytes:
+        pass
+
+
+class DirectoryImageStore(ImageStore):
+    def __init__(self, image_dir: Path):
+        self._image_dir = image_dir
+
+    def keys(self):
+        if not self._image_dir.exists():
+            return []
+
+        return sorted(
+            int(f.stem) for f in self._image_dir.glob(f"*{constant.IMAGE_EXTENSION}") if f.stem.isdigit()
+        )
+
+    def __contains__(self, frame_id: int):
+        return self.get(frame_id).exists()
+
+    def get(self, frame_id: int) -> Path:
+        return self._image_dir / f"{frame_id:06d}{constant.IMAGE_EXTENSION}"
+
+    def read_bytes(self, frame_id: int):
+        return self.get(frame_id).read_bytes()
+
+
+class PackedImageStore(ImageStore):
+    # Parts written by different workers are merged, a part written later overrides the images of earlier ones
+    def __init__(self, image_dir: Path):
+        self._images = {}
+
+        index_paths = sorted(image_dir.glob(f"{IMAGE_STORE_PREFIX}*.json"), key=lambda p: p.stat().st_mtime_ns)
+        for index_path in index_paths:
+            with open(index_path, "r") as f:
+                index = json.load(f)
+
+            if len(index) == 0:
+                continue
+
+            data = np.memmap(index_path.with_suffix(".bin"), dtype=np.uint8, mode="r")
+            for frame_id, (offset, size) in index.items():
+                self._images[int(frame_id)] = (data, offset, size)
+
+    @staticmethod
+    def exists(image_dir: Path):
+        return image_dir.exists() and any(image_dir.glob(f"{IMAGE_STORE_PREFIX}*.json"))
+
+    def keys(self):
+        return sorted(self._images.keys())
+
+    def __contains__(self, frame_id: int):
+        return frame_id in self._images
+
+    def get(self, frame_id: int) -> np.ndarray:
+        data, offset, size = self._images[frame_id]
+        return data[offset : offset + size]
+
+    def read_bytes(self, frame_id: int):
+        return self.get(frame_id).tobytes()
+
+
+def open_image_store(image_dir: Path) -> ImageStore:
+    if PackedImageStore.exists(image_dir):
+        return PackedImageStore(image_dir)
+    return DirectoryImageStore(image_dir)
+
+
+class DirectoryImageStoreWriter:
+    def __init__(self, image_dir: Path):
+        self._image_dir = image_dir
+
+    def __enter__(self):
+        self._image_dir.mkdir(parents=True, exist_ok=True)
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def put(self, frame_id: int, data: bytes):
+        with open(self._image_dir / f"{frame_id:06d}{constant.IMAGE_EXTENSION}", "wb") as f:
+            f.write(data)
+
+
+class PackedImageStoreWriter:
+    # Encoded images are appended to one data file, both files are renamed in place once complete so that readers
+    # never map a file being written
+    def __init__(self, image_dir: Path, name: str):
+        self._data_path = image_dir / f"{IMAGE_STORE_PREFIX}{name}.bin"
+        self._index_path = image_dir / f"{IMAGE_STORE_PREFIX}{name}.json"
+        self._tmp_data_path = image_dir / f".{self._data_path.name}.tmp"
+        self._file = None
+        self._lock = Lock()
+        self._offset = 0
+        self._index = {}
+
+    def __enter__(self):
+        self._data_path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self._tmp_data_path, "wb")
+        return self
+
+    def __exit__(self, exc_type, *args):
+        assert self._file is not None
+        self._file.close()
+
+        if exc_type is not None:
+            os.remove(self._tmp_data_path)
+            return
+
+        tmp_index_path = self._index_path.with_name(f".{self._index_path.name}.tmp")
+        with open(tmp_index_path, "w") as f:
+            json.dump(self._index, f)
+
+        os.replace(self._tmp_data_path, self._data_path)
+        os.replace(tmp_index_path, self._index_path)
+
+    def put(self, frame_id: int, data: bytes):
+        assert self._file is not None
+
+        with self._lock:
+            self._file.write(data)
+            self._index[str(frame_id)] = [self._offset, len(data)]
+            self._offset += len(data)
+
+
+def create_image_store_writer(image_dir: Path, image_format: str, name: str):
+    if image_format == "packed":
+        return PackedImageStoreWriter(image_dir, name)
+    elif image_format == "jpg":
+        return DirectoryImageStoreWriter(image_dir)
+    else:
+        raise RuntimeError(f"image_format={image_format} is invalid")
+
+
+def remove_images(image_dir: Path, frame_ids: set[int]):
+    # Packed parts holding removed images are rewritten without them
+    if not PackedImageStore.exists(image_dir):
+        for frame_id in frame_ids:
+            DirectoryImageStore(image_dir).get(frame_id).unlink(missing_ok=True)
+        return
+
+    for index_path in sorted(image_dir.glob(f"{IMAGE_STORE_PREFIX}*.json")):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+        if not any(int(frame_id) in frame_ids for frame_id in index):
+            continue
+
+        data = np.memmap(index_path.with_suffix(".bin"), dtype=np.uint8, mode="r")
+        with PackedImageStoreWriter(image_dir, index_path.stem[len(IMAGE_STORE_PREFIX) :]) as store_writer:
+            for frame_id, (offset, size) in index.items():
+                if int(frame_id) not in frame_ids:
+                    store_writer.put(int(frame_id), data[offset : offset + size].tobytes())
+        del data
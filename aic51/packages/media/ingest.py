@@ -0,0 +1,110 @@
+import subprocess
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+
+
+class FFmpegIngest:
+    # One ffmpeg process decodes the video once and writes every output, decoded frames are read from its stdout
+    PIXEL_CHANNELS = {
+        "bgr24": 3,
+        "gray": 1,
+    }
+
+    def __init__(
+        self,
+        video_path: Path | str,
+        output_args: list[str],
+        frame_size: tuple[int, int] | None = None,
+        pix_fmt: str = "bgr24",
+    ):
+        self._frame_size = frame_size
+        self._pix_fmt = pix_fmt
+        self._cmd = ["ffmpeg", "-v", "quiet", "-y"] + ["-i", str(video_path)] + output_args
+        if frame_size is not None:
+            self._cmd += [
+                "-map",
+                "0:v:0",
+                "-vf",
+                f"scale={frame_size[0]}:{frame_size[1]}",
+                "-fps_mode",
+                "passthrough",
+                "-pix_fmt",
+                pix_fmt,
+                "-f",
+                "rawvideo",
+                "pipe:1",
+            ]
+        self._process = None
+
+    def __enter__(self):
+        self._process = subprocess.Popen(
+            self._cmd,
+            stdout=subprocess.PIPE if self._frame_size is not None else subprocess.DEVNULL,
+        )
+        return self
+
+    def __exit__(self, exc_type, *args):
+        assert self._process is not None
+        if exc_type is not None:
+            self._process.kill()
+        elif self._process.stdout is not None:
+            # ffmpeg blocks on a full pipe, the frames left must be read for the other outputs to be finished
+            while self._process.stdout.read(1 << 20):
+                pass
+
+        returncode = self._process.wait()
+        if self._process.stdout is not None:
+            self._process.stdout.close()
+
+        if exc_type is None and returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with code {returncode}: {' '.join(self._cmd)}")
+
+    def read_frames(self, frame_ids: Iterable[int]) -> Iterator[tuple[int, np.ndarray]]:
+        # Same contract as read_frames, frames can only be read in order so skipped frames are read and dropped
+        assert self._process is not None and self._process.stdout is not None
+        assert self._frame_size is not None
+
+        pipe = self._process.stdout
+        frame_shape = self._get_frame_shape()
+        skipped_frame = np.empty(frame_shape, dtype=np.uint8)
+
+        position = 0  # index of the next frame in the pipe
+        for frame_id in frame_ids:
+            while position < frame_id:
+                if pipe.readinto(memoryview(skipped_frame).cast("B")) < skipped_frame.nbytes:
+                    return
+                position += 1
+
+            frame = np.empty(frame_shape, dtype=np.uint8)
+            if pipe.readinto(memoryview(frame).cast("B")) < frame.nbytes:
+                return
+            position += 1
+
+            yield frame_id, frame
+
+    def read_batches(self, batch_size: int) -> Iterator[np.ndarray]:
+        # Consecutive frames are read as arrays of up to batch_size frames
+        assert self._process is not None and self._process.stdout is not None
+        assert self._frame_size is not None
+
+        pipe = self._process.stdout
+        frame_shape = self._get_frame_shape()
+        frame_nbytes = int(np.prod(frame_shape))
+
+        while True:
+            batch = np.empty((batch_size, *frame_shape), dtype=np.uint8)
+            nbytes = pipe.readinto(memoryview(batch).cast("B"))
+            num_frames = nbytes // frame_nbytes
+            if num_frames > 0:
+                yield batch[:num_frames]
+            if num_frames < batch_size:
+                return
+
+    def _get_frame_shape(self):
+        assert self._frame_size is not None
+
+        width, height = self._frame_size
+        channels = self.PIXEL_CHANNELS[self._pix_fmt]
+        return (height, width) if channels == 1 else (height, width, channels)
@@ -0,0 +1,33 @@
+from bisect import bisect_left
+from math import ceil
+from typing import Iterator
+
+
+def iter_keyframe_ids(keyframes_list: list[int], max_scene_length: float) -> Iterator[int]:
+    # Same selection as the scene_length counter of the sequential pass: a frame is selected if it is in
+    # keyframes_list or if max_scene_length frames have passed since the last selected frame
+    keyframes_list = sorted(keyframes_list)
+    step = max(1, ceil(max_scene_length))
+
+    scene_start = 0
+    next_frame = 0
+    while True:
+        i = bisect_left(keyframes_list, next_frame)
+        fallback = scene_start + step
+        frame_id = min(keyframes_list[i], fallback) if i < len(keyframes_list) else fallback
+
+        yield frame_id
+
+        scene_start = frame_id
+        next_frame = frame_id + 1
+
+
+def split_chunks(keyframes_list: list[int], num_frames: int, chunk_length: float) -> list[tuple[int, int | None]]:
+    # Chunks start at I-frames so that each of them can be decoded on its own after a seek. The last chunk is
+    # left open since the frame count of the container is not always exact
+    boundaries = [0]
+    for keyframe in sorted(keyframes_list):
+        if keyframe - boundaries[-1] >= chunk_length and num_frames - keyframe >= chunk_length / 2:
+            boundaries.append(keyframe)
+
+    return list(zip(boundaries, boundaries[1:] + [None]))
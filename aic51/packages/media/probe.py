@@ -0,0 +1,155 @@
+import json
+import os
+import subprocess
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+import aic51.packages.constant as constant
+
+MEDIA_INFO_KEYS = [
+    constant.FPS_KEY,
+    constant.DURATION_KEY,
+    constant.WIDTH_KEY,
+    constant.HEIGHT_KEY,
+    constant.NUM_FRAMES_KEY,
+    constant.KEYFRAMES_KEY,
+    constant.SOURCE_KEYFRAMES_KEY,
+    constant.MTIME_KEY,
+    constant.SIZE_KEY,
+]
+
+
+def probe_keyframes(video_path: Path | str) -> np.ndarray:
+    # Packet flags are read from the container without decoding any frame
+    ffprobe_cmd = ["ffprobe", "-v", "quiet"] + [
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts,flags",
+        "-of",
+        "csv=p=0",
+        str(video_path),
+    ]
+
+    packets_pts = array("q")
+    keyframes_pts = array("q")
+    with subprocess.Popen(ffprobe_cmd, stdout=subprocess.PIPE, text=True) as process:
+        assert process.stdout is not None
+        for line in process.stdout:
+            pts, _, flags = line.strip().partition(",")
+            if not pts.lstrip("-").isdigit():
+                continue
+
+            packets_pts.append(int(pts))
+            if flags.startswith("K"):
+                keyframes_pts.append(int(pts))
+
+    # Packets are in decoding order, the rank of their pts gives the frame index in presentation order
+    packets_pts = np.sort(np.frombuffer(packets_pts, dtype=np.int64))
+    keyframes_pts = np.frombuffer(keyframes_pts, dtype=np.int64)
+
+    return np.unique(np.searchsorted(packets_pts, keyframes_pts))
+
+
+def probe_stream(video_path: Path | str) -> dict:
+    ffprobe_cmd = ["ffprobe", "-v", "quiet", "-of", "json"] + [
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "stream=r_frame_rate,width,height,nb_frames,duration:format=duration",
+        str(video_path),
+    ]
+    res = subprocess.run(ffprobe_cmd, capture_output=True, text=True)
+    data = json.loads(res.stdout or "{}")
+
+    streams = data.get("streams") or []
+    if len(streams) == 0:
+        raise RuntimeError(f"{video_path}: No video stream found")
+    stream = streams[0]
+
+    fraction = stream["r_frame_rate"].split("/")
+    frame_rate = int(fraction[0]) / int(fraction[1])
+    duration = float(stream.get("duration") or data.get("format", {}).get("duration") or 0)
+    num_frames = int(stream.get("nb_frames") or round(duration * frame_rate))
+
+    return {
+        constant.FPS_KEY: round(frame_rate),
+        constant.DURATION_KEY: duration,
+        constant.WIDTH_KEY: int(stream["width"]),
+        constant.HEIGHT_KEY: int(stream["height"]),
+        constant.NUM_FRAMES_KEY: num_frames,
+    }
+
+
+def probe_has_audio(video_path: Path | str) -> bool:
+    ffprobe_cmd = ["ffprobe", "-v", "quiet"] + [
+        "-select_streams",
+        "a",
+        "-show_entries",
+        "stream=index",
+        "-of",
+        "csv=p=0",
+        str(video_path),
+    ]
+    res = subprocess.run(ffprobe_cmd, capture_output=True, text=True)
+    return len(res.stdout.strip()) > 0
+
+
+def probe_media_info(
+    video_path: Path, source_keyframes: list[int] | None = None, source_path: Path | None = None
+) -> dict:
+    # Keyframes are the I-frames of the file itself, used to seek and split it. Source keyframes are the I-frames of
+    # the original encoding, used to select scenes, they are kept when the video is re-encoded
+    stat = video_path.stat()
+
+    media_info = probe_stream(video_path)
+    keyframes = probe_keyframes(video_path).tolist()
+    if source_keyframes is None:
+        source_keyframes = probe_keyframes(source_path).tolist() if source_path is not None else keyframes
+    media_info[constant.KEYFRAMES_KEY] = keyframes
+    media_info[constant.SOURCE_KEYFRAMES_KEY] = source_keyframes
+    media_info[constant.MTIME_KEY] = stat.st_mtime_ns
+    media_info[constant.SIZE_KEY] = stat.st_size
+
+    return media_info
+
+
+def save_media_info(info_path: Path, media_info: dict):
+    info_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = info_path.with_name(f".{info_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(media_info, f)
+    os.replace(tmp_path, info_path)
+
+
+def load_media_info(info_path: Path, video_path: Path, source_path: Path | None = None) -> dict:
+    # The record is reused until the video file changes, source_path is only probed when it is stale
+    stat = video_path.stat()
+
+    try:
+        with open(info_path, "r") as f:
+            media_info = json.load(f)
+    except (OSError, ValueError):
+        media_info = None
+
+    if (
+        isinstance(media_info, dict)
+        and media_info.get(constant.MTIME_KEY) == stat.st_mtime_ns
+        and media_info.get(constant.SIZE_KEY) == stat.st_size
+    ):
+        if all(k in media_info for k in MEDIA_INFO_KEYS):
+            return media_info
+
+        # Records written before source keyframes were stored hold the keyframes of the original encoding
+        if constant.KEYFRAMES_KEY in media_info:
+            media_info = probe_media_info(video_path, source_keyframes=media_info[constant.KEYFRAMES_KEY])
+            save_media_info(info_path, media_info)
+            return media_info
+
+    media_info = probe_media_info(video_path, source_path=source_path)
+    save_media_info(info_path, media_info)
+
+    return media_info
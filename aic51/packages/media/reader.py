@@ -0,0 +1,40 @@
+from bisect import bisect_right
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import cv2
+import numpy as np
+
+
+def read_frames(
+    video_path: Path | str,
+    frame_ids: Iterable[int],
+    keyframes_list: list[int] | np.ndarray,
+    do_seek: bool = True,
+) -> Iterator[tuple[int, np.ndarray]]:
+    # frame_ids must be increasing, it can be unbounded as reading stops at the end of the video
+    keyframes_list = sorted(keyframes_list)
+
+    cap = cv2.VideoCapture(str(video_path))
+    try:
+        position = 0  # index of the next frame to be decoded
+        for frame_id in frame_ids:
+            # Seeking only pays off when decoding can restart from an I-frame after the current position
+            i = bisect_right(keyframes_list, frame_id) - 1
+            if do_seek and i >= 0 and keyframes_list[i] > position:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_id)
+                position = frame_id
+
+            while position < frame_id and cap.grab():
+                position += 1
+            if position < frame_id:
+                break
+
+            ret, frame = cap.read()
+            if not ret:
+                break
+            position += 1
+
+            yield frame_id, frame
+    finally:
+        cap.release()
@@ -0,0 +1,107 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import numpy as np
+
+import aic51.packages.constant as constant
+
+from .ingest import FFmpegIngest
+
+
+class KeyframeSelector(ABC):
+    # Returns the frames starting a scene, iter_keyframe_ids adds frames to scenes longer than max_scene_length
+    @abstractmethod
+    def select(self, video_path: Path, media_info: dict) -> list[int]:
+        pass
+
+
+class KeyframeSelectorFactory:
+    __registry = {}
+
+    @staticmethod
+    def register(k: str):
+        def wrapper(selector_cls):
+            if issubclass(selector_cls, KeyframeSelector):
+                KeyframeSelectorFactory.__registry[k] = selector_cls
+            return selector_cls
+
+        return wrapper
+
+    @staticmethod
+    def get(k: str) -> type[KeyframeSelector] | None:
+        if k in KeyframeSelectorFactory.__registry:
+            return KeyframeSelectorFactory.__registry[k]
+        else:
+            return None
+
+
+@KeyframeSelectorFactory.register("iframe")
+class IFrameSelector(KeyframeSelector):
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def select(self, video_path: Path, media_info: dict) -> list[int]:
+        return list(media_info[constant.SOURCE_KEYFRAMES_KEY])
+
+
+@KeyframeSelectorFactory.register("scene")
+class SceneCutSelector(KeyframeSelector):
+    NUM_BINS = 16
+
+    def __init__(
+        self,
+        threshold: float = 0.3,
+        min_scene_length: float = 0.5,
+        frame_size: tuple[int, int] = (64, 36),
+        batch_size: int = 1024,
+        *args,
+        **kwargs,
+    ):
+        self._threshold = threshold
+        self._min_scene_length = min_scene_length  # in seconds
+        self._frame_size = frame_size
+        self._batch_size = batch_size
+
+    def select(self, video_path: Path, media_info: dict) -> list[int]:
+        scores = self.get_scores(video_path)
+        min_scene_length = max(1, round(self._min_scene_length * media_info[constant.FPS_KEY]))  # in frames
+
+        cuts = [0]
+        for frame_id in np.flatnonzero(scores > self._threshold).tolist():
+            if frame_id - cuts[-1] >= min_scene_length:
+                cuts.append(frame_id)
+
+        return cuts
+
+    def get_scores(self, video_path: Path) -> np.ndarray:
+        # Score of frame i is the change from frame i - 1: the mean of the histogram distance and the mean absolute
+        # luma difference of small grayscale frames, both in [0, 1]
+        scores = []
+        prev_frame = None
+        prev_hist = None
+        with FFmpegIngest(video_path, [], self._frame_size, pix_fmt="gray") as ingest:
+            for frames in ingest.read_batches(self._batch_size):
+                hists = self._get_histograms(frames)
+
+                if prev_frame is None:
+                    prev_frame, prev_hist = frames[:1], hists[:1]
+                    scores.append(np.zeros(1))
+
+                all_frames = np.concatenate([prev_frame, frames]).astype(np.int16)
+                all_hists = np.concatenate([prev_hist, hists])
+
+                hist_diff = 0.5 * np.abs(np.diff(all_hists, axis=0)).sum(axis=1)
+                luma_diff = np.abs(np.diff(all_frames, axis=0)).mean(axis=(1, 2)) / 255
+                scores.append(((hist_diff + luma_diff) / 2)[-len(frames) :])
+
+                prev_frame, prev_hist = frames[-1:], hists[-1:]
+
+        # The first frame was scored against itself
+        return np.concatenate(scores)[1:] if len(scores) > 0 else np.zeros(0)
+
+    def _get_histograms(self, frames: np.ndarray) -> np.ndarray:
+        n = len(frames)
+        bins = (frames.reshape(n, -1) >> 4).astype(np.int64)  # 16 bins of 8-bit values
+        offsets = bins + self.NUM_BINS * np.arange(n)[:, None]
+        hists = np.bincount(offsets.ravel(), minlength=n * self.NUM_BINS).reshape(n, self.NUM_BINS)
+        return hists / bins.shape[1]
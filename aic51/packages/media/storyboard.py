@@ -0,0 +1,93 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import aic51.packages.constant as constant
+
+from .images import ImageStore
+
+STORYBOARD_INDEX_NAME = "index.json"
+STORYBOARD_SHEET_PREFIX = "sheet_"
+
+
+def get_storyboard_sheet_path(storyboard_dir: Path, sheet_id: int) -> Path:
+    return storyboard_dir / f"{STORYBOARD_SHEET_PREFIX}{sheet_id:04d}{constant.IMAGE_EXTENSION}"
+
+
+def load_storyboard_index(storyboard_dir: Path) -> dict | None:
+    try:
+        with open(storyboard_dir / STORYBOARD_INDEX_NAME, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_storyboard(
+    storyboard_dir: Path,
+    image_store: ImageStore,
+    tile_width: int = 160,
+    columns: int = 10,
+    rows: int = 10,
+    jpeg_quality: int = 70,
+):
+    # Images are tiled in frame order into sheets of columns x rows tiles, the index maps each frame to its tile
+    frame_ids = image_store.keys()
+    tile_size = None
+    tiles = []
+    sheet = None
+    tiles_per_sheet = columns * rows
+
+    tmp_dir = storyboard_dir.with_name(f".{storyboard_dir.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    def write_sheet(sheet_id: int, sheet: np.ndarray):
+        ok, buffer = cv2.imencode(constant.IMAGE_EXTENSION, sheet, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        if not ok:
+            raise RuntimeError(f"Cannot encode storyboard sheet {sheet_id} of {storyboard_dir.name}")
+        get_storyboard_sheet_path(tmp_dir, sheet_id).write_bytes(buffer.tobytes())
+
+    for frame_id in frame_ids:
+        data = np.frombuffer(image_store.read_bytes(frame_id), dtype=np.uint8)
+        image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        if image is None:
+            continue
+
+        if tile_size is None:
+            height, width = image.shape[:2]
+            tile_size = (tile_width, max(1, round(tile_width * height / width)))
+
+        sheet_id, position = divmod(len(tiles), tiles_per_sheet)
+        if position == 0:
+            if sheet is not None:
+                write_sheet(sheet_id - 1, sheet)
+            sheet = np.zeros((rows * tile_size[1], columns * tile_size[0], 3), dtype=np.uint8)
+
+        y, x = divmod(position, columns)
+        x, y = x * tile_size[0], y * tile_size[1]
+        sheet[y : y + tile_size[1], x : x + tile_size[0]] = cv2.resize(image, tile_size, interpolation=cv2.INTER_AREA)
+        tiles.append({"frame_id": frame_id, "sheet": sheet_id, "x": x, "y": y})
+
+    if sheet is not None:
+        write_sheet((len(tiles) - 1) // tiles_per_sheet, sheet)
+
+    index = {
+        "tile_width": tile_size[0] if tile_size is not None else tile_width,
+        "tile_height": tile_size[1] if tile_size is not None else 0,
+        "columns": columns,
+        "rows": rows,
+        "num_sheets": (len(tiles) + tiles_per_sheet - 1) // tiles_per_sheet,
+        "tiles": tiles,
+    }
+    with open(tmp_dir / STORYBOARD_INDEX_NAME, "w") as f:
+        json.dump(index, f)
+
+    # The new sheets replace the old ones at once
+    shutil.rmtree(storyboard_dir, ignore_errors=True)
+    os.replace(tmp_dir, storyboard_dir)
+
+    return index
@@ -0,0 +1,72 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import BoundedSemaphore, Lock
+
+import cv2
+import numpy as np
+
+import aic51.packages.constant as constant
+
+
+class ImageWriter:
+    # Encodes images in a thread pool and puts them to image store writers, write blocks while max_pending images
+    # are waiting
+    def __init__(self, max_workers: int = 2, max_pending: int = 32, jpeg_quality: int = 50):
+        self._executor = ThreadPoolExecutor(max(1, max_workers))
+        self._slots = BoundedSemaphore(max(1, max_pending))
+        self._params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        self._lock = Lock()
+        self._futures = set()
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def write(self, store_writer, frame_id: int, image: np.ndarray):
+        self._raise_error()
+
+        # Views are copied since their memory can be reused before the image is written
+        if not image.flags.owndata:
+            image = image.copy()
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._write, store_writer, frame_id, image)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._on_done)
+
+    def flush(self):
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+        self._raise_error()
+
+    def _write(self, store_writer, frame_id: int, image: np.ndarray):
+        ret, data = cv2.imencode(constant.IMAGE_EXTENSION, image, self._params)
+        if not ret:
+            raise RuntimeError(f"frame_id={frame_id}: Cannot encode image")
+
+        store_writer.put(frame_id, data.tobytes())
+
+    def _on_done(self, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+            if self._error is None and future.exception() is not None:
+                self._error = future.exception()
+        self._slots.release()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
@@ -1,5 +1,7 @@
 import hashlib
 import time
+from functools import lru_cache
+from pathlib import Path
 from typing import Optional
 
 import torch
@@ -10,6 +12,7 @@ from aic51.packages.analyse import FeatureExtractorFactory
 from aic51.packages.config import GlobalConfig
 from aic51.packages.index import MilvusDatabase
 from aic51.packages.logger import logger
+from aic51.packages.media import get_scene_ends, load_duplicates
 
 from . import constants
 from .utils import Query
@@ -25,7 +28,7 @@ class Searcher(object):
     def to(self, device):
         self._device = torch.device(device)
         for e in self._extractors.values():
-            e.to(device)
+            e["feature_extractor"].to(device)
 
     def get(self, id):
         return self._database.get(id)
@@ -328,7 +331,8 @@ class Searcher(object):
                 cur_vid, cur_fid = cur["_id"]
 
                 low_id = (cur_vid, cur_fid)
-                high_id = (cur_vid, cur_fid + max_interval)
+                # A keyframe with dropped duplicates stands for every frame up to its last duplicate
+                high_id = (cur_vid, self._get_scene_end(cur_vid, cur_fid) + max_interval)
 
                 cur_fid = int(cur_fid)
 
@@ -364,6 +368,16 @@ class Searcher(object):
 
         return best
 
+    def _get_scene_end(self, video_id: str, frame_id: int):
+        duplicates_path = Path.cwd() / constant.DUPLICATE_DIR / f"{video_id}.json"
+        try:
+            mtime = duplicates_path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+
+        # Scene ends are reloaded when the duplicates of the video are written again by add
+        return _load_scene_ends(duplicates_path, mtime).get(frame_id, frame_id)
+
     def _get_videos(self, video_ids: list[str], offset: int = 0, limit: int = 10000, selected: Optional[str] = None):
         query_str = f"{constants.CACHE_GET_VIDEOS}:{repr(video_ids)}"
         query_hash = hashlib.sha256(query_str.encode("utf-8")).hexdigest()
@@ -406,6 +420,7 @@ class Searcher(object):
             model_name = GlobalConfig.get("searcher", "language_models", m, "model")
             arch_name = GlobalConfig.get("searcher", "language_models", m, "arch_name")
             pretrained_model = GlobalConfig.get("searcher", "language_models", m, "pretrained_model")
+            runtime = GlobalConfig.get("searcher", "language_models", m, "runtime") or "torch"
             target_features = GlobalConfig.get("searcher", "language_models", m, "target")
             batch_size = 1
 
@@ -420,6 +435,7 @@ class Searcher(object):
                     name=m,
                     batch_size=batch_size,
                     device=device,
+                    runtime=runtime,
                 )
             else:
                 feature_extractor = None
@@ -439,3 +455,8 @@ class Searcher(object):
                 self._features[t] = m
 
             self._extractors[m] = {"feature_extractor": feature_extractor, "target_features": target_features}
+
+
+@lru_cache(maxsize=256)
+def _load_scene_ends(duplicates_path: Path, mtime: int | None):
+    return get_scene_ends(load_duplicates(duplicates_path))
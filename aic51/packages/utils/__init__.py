@@ -1,2 +1,5 @@
 from .device import *
+from .feature_store import *
 from .files import *
+from .manifest import *
+from .progress import *
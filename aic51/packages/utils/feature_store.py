@@ -0,0 +1,198 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+FEATURE_STORE_SUFFIXES = [".json", ".ids", ".bin", ".offsets"]
+
+
+def get_feature_names(video_dir: Path) -> list[str]:
+    if not video_dir.is_dir():
+        return []
+    return sorted(p.stem for p in video_dir.glob("*.json") if not p.name.startswith("."))
+
+
+def remove_feature_store(video_dir: Path, name: str):
+    for suffix in FEATURE_STORE_SUFFIXES:
+        (video_dir / f"{name}{suffix}").unlink(missing_ok=True)
+
+
+def _get_num_rows(paths: list[Path], row_nbytes: list[int]) -> int:
+    # Files are appended one after another, rows are complete only when they are complete in every file
+    return min(p.stat().st_size // n if p.exists() else 0 for p, n in zip(paths, row_nbytes))
+
+
+class FeatureStoreWriter:
+    # Features of a video are appended to one file per feature: vectors as the rows of a matrix, texts as utf-8 bytes
+    # with their end offsets. Frame ids are appended last so that an interrupted write leaves no partial row
+    def __init__(self, video_dir: Path, name: str):
+        self._video_dir = video_dir
+        self._name = name
+        self._header_path = video_dir / f"{name}.json"
+        self._ids_path = video_dir / f"{name}.ids"
+        self._data_path = video_dir / f"{name}.bin"
+        self._offsets_path = video_dir / f"{name}.offsets"
+
+        self._header = None
+        self._files = None
+        self._data_size = 0
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        self._video_dir.mkdir(parents=True, exist_ok=True)
+        if self._header_path.exists():
+            with open(self._header_path, "r") as f:
+                self._open(json.load(f))
+        return self
+
+    def close(self):
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+            self._files = None
+
+    def write(self, frame_ids: list[int], features: np.ndarray | list[str]):
+        features = np.asarray(features)
+        if len(frame_ids) != len(features):
+            raise ValueError(f"FeatureStoreWriter: {len(frame_ids)} frame ids for {len(features)} features")
+        if len(frame_ids) == 0:
+            return
+
+        header = self._get_header(features)
+        if self._header is None:
+            tmp_path = self._header_path.with_name(f".{self._header_path.name}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(header, f)
+            os.replace(tmp_path, self._header_path)
+            self._open(header)
+        elif header != self._header:
+            raise RuntimeError(
+                f"{self._name} of {self._video_dir.name} is stored as {self._header}, got {header}. "
+                "Analyse again with --overwrite."
+            )
+
+        assert self._files is not None
+        ids_file = self._files[0]
+        if self._header["kind"] == "text":
+            data_file, offsets_file = self._files[1:]
+            data = [str(text).encode("utf-8") for text in features]
+            offsets = self._data_size + np.cumsum([len(d) for d in data], dtype=np.int64)
+
+            data_file.write(b"".join(data))
+            data_file.flush()
+            offsets_file.write(offsets.tobytes())
+            offsets_file.flush()
+            self._data_size = int(offsets[-1])
+        else:
+            data_file = self._files[1]
+            data_file.write(np.ascontiguousarray(features, dtype=self._header["dtype"]).tobytes())
+            data_file.flush()
+
+        ids_file.write(np.asarray(frame_ids, dtype=np.int64).tobytes())
+        ids_file.flush()
+
+    def _get_header(self, features: np.ndarray):
+        if features.dtype.kind in "USO":
+            return {"kind": "text"}
+        return {"kind": "vector", "dtype": features.dtype.str, "shape": list(features.shape[1:])}
+
+    def _open(self, header: dict):
+        self._header = header
+
+        # Rows left incomplete by an interrupted write are dropped before appending
+        if header["kind"] == "text":
+            num_rows = _get_num_rows([self._ids_path, self._offsets_path], [8, 8])
+            offsets = np.fromfile(self._offsets_path, dtype=np.int64, count=num_rows) if num_rows > 0 else []
+            self._data_size = int(offsets[-1]) if num_rows > 0 else 0
+            sizes = [num_rows * 8, self._data_size, num_rows * 8]
+            paths = [self._ids_path, self._data_path, self._offsets_path]
+        else:
+            row_nbytes = int(np.dtype(header["dtype"]).itemsize * np.prod(header["shape"], dtype=np.int64))
+            num_rows = _get_num_rows([self._ids_path, self._data_path], [8, row_nbytes])
+            sizes = [num_rows * 8, num_rows * row_nbytes]
+            paths = [self._ids_path, self._data_path]
+
+        self._files = []
+        for path, size in zip(paths, sizes):
+            f = open(path, "ab")
+            f.truncate(size)
+            self._files.append(f)
+
+
+class FeatureStore:
+    # Rows written later override earlier rows of the same frame
+    def __init__(self, video_dir: Path, name: str):
+        self._name = name
+
+        with open(video_dir / f"{name}.json", "r") as f:
+            self._header = json.load(f)
+
+        ids_path = video_dir / f"{name}.ids"
+        data_path = video_dir / f"{name}.bin"
+        offsets_path = video_dir / f"{name}.offsets"
+        if self._header["kind"] == "text":
+            num_rows = _get_num_rows([ids_path, offsets_path], [8, 8])
+            if num_rows > 0:
+                self._offsets = np.fromfile(offsets_path, dtype=np.int64, count=num_rows)
+            else:
+                self._offsets = np.zeros(0, dtype=np.int64)
+            self._data = np.memmap(data_path, dtype=np.uint8, mode="r") if np.any(self._offsets > 0) else b""
+        else:
+            shape = self._header["shape"]
+            row_nbytes = int(np.dtype(self._header["dtype"]).itemsize * np.prod(shape, dtype=np.int64))
+            num_rows = _get_num_rows([ids_path, data_path], [8, row_nbytes])
+            if num_rows > 0:
+                self._data = np.memmap(data_path, dtype=self._header["dtype"], mode="r", shape=(num_rows, *shape))
+            else:
+                self._data = np.empty((0, *shape), dtype=self._header["dtype"])
+
+        self._frame_ids = np.fromfile(ids_path, dtype=np.int64, count=num_rows) if num_rows > 0 else np.empty(0)
+        self._rows = {int(frame_id): row for row, frame_id in enumerate(self._frame_ids.tolist())}
+
+    @staticmethod
+    def exists(video_dir: Path, name: str):
+        return (video_dir / f"{name}.json").exists()
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def is_text(self):
+        return self._header["kind"] == "text"
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, frame_id: int):
+        return frame_id in self._rows
+
+    def keys(self) -> list[int]:
+        return sorted(self._rows.keys())
+
+    def get(self, frame_id: int) -> np.ndarray | str:
+        return self._get_row(self._rows[frame_id])
+
+    def get_all(self) -> tuple[list[int], np.ndarray | list[str]]:
+        # Frame ids in order with their features, vectors are a read-only view of the data file
+        frame_ids = self.keys()
+        rows = [self._rows[frame_id] for frame_id in frame_ids]
+        if self.is_text:
+            return frame_ids, [self._get_row(row) for row in rows]
+
+        if rows == list(range(len(self._frame_ids))):
+            return frame_ids, self._data
+        return frame_ids, self._data[rows]
+
+    def _get_row(self, row: int):
+        if self.is_text:
+            start = int(self._offsets[row - 1]) if row > 0 else 0
+            return bytes(self._data[start : int(self._offsets[row])]).decode("utf-8")
+        return self._data[row]
+
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    # Without POSIX file locks, only the threads of one add run are serialized
+    fcntl = None
+
+
+def hash_file(file_path: Path, block_size: int = 4 * 1024 * 1024) -> str:
+    # The whole file is hashed in blocks, a source changed anywhere redoes its stages
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        while block := f.read(block_size):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+
+def fingerprint(*values) -> str:
+    return hashlib.blake2b(json.dumps(values, sort_keys=True, default=str).encode(), digest_size=8).hexdigest()
+
+
+class Manifest:
+    # Records for each video the hash of its source and the fingerprint of the config of each completed stage. Every
+    # update re-reads the manifest under a file lock and merges into it, so that concurrent add runs keep the records
+    # of each other
+    def __init__(self, manifest_path: Path):
+        self._path = manifest_path
+        self._lock_path = manifest_path.with_name(f".{manifest_path.name}.lock")
+        self._lock = Lock()
+        self._records = self._load()
+
+    def seed(self, video_id: str, source_hash: str | None, stages: dict[str, str]):
+        # Videos added before the manifest existed get the stages whose outputs exist instead of being redone
+        with self._update() as records:
+            if video_id not in records and len(stages) > 0:
+                records[video_id] = {"source": source_hash, "stages": dict(stages)}
+
+    def update_source(self, video_id: str, source_hash: str) -> bool:
+        # Every stage is reset when the source changed, returns whether it did
+        with self._update() as records:
+            record = records.get(video_id)
+            if record is not None and record["source"] == source_hash:
+                return False
+
+            records[video_id] = {"source": source_hash, "stages": {}}
+            return True
+
+    def is_done(self, video_id: str, stage: str, stage_fingerprint: str) -> bool:
+        with self._lock:
+            record = self._records.get(video_id)
+            return record is not None and record["stages"].get(stage) == stage_fingerprint
+
+    def start(self, video_id: str, stage: str):
+        # The marker is removed first so that a stage interrupted midway is never seen as done
+        with self._update() as records:
+            record = records.get(video_id)
+            if record is not None:
+                record["stages"].pop(stage, None)
+
+    def done(self, video_id: str, stage: str, stage_fingerprint: str):
+        with self._update() as records:
+            record = records.setdefault(video_id, {"source": None, "stages": {}})
+            record["stages"][stage] = stage_fingerprint
+
+    @contextmanager
+    def _update(self):
+        with self._lock:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self._lock_path, "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                self._records = self._load()
+                yield self._records
+                self._save()
+
+    def _load(self) -> dict:
+        try:
+            with open(self._path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        tmp_path = self._path.with_name(f".{self._path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._records, f)
+        os.replace(tmp_path, self._path)
@@ -0,0 +1,44 @@
+from threading import Thread
+
+from rich.progress import Progress
+
+
+class ProgressReporter:
+    def __init__(self, queue, task_id):
+        self._queue = queue
+        self._task_id = task_id
+
+    def __call__(self, **kwargs):
+        self._queue.put((self._task_id, kwargs))
+
+
+class ProgressListener:
+    # Forwards updates sent by ProgressReporter from other processes to a rich Progress
+    def __init__(self, progress: Progress, queue):
+        self._progress = progress
+        self._queue = queue
+        self._thread = Thread(target=self._listen, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._queue.put(None)
+        self._thread.join()
+
+    def reporter(self, task_id) -> ProgressReporter:
+        return ProgressReporter(self._queue, task_id)
+
+    def _listen(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            task_id, kwargs = item
+            try:
+                self._progress.update(task_id, **kwargs)
+            except KeyError:
+                # The task has been removed before its last updates arrived
+                pass
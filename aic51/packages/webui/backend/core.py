@@ -228,6 +228,55 @@ async def get_frame(request: Request, video_id: str, frame_id: str):
         )
 
 
+@app.get(constant.STORYBOARD_ENDPOINT + "/{video_id}")
+async def get_storyboard(request: Request, video_id: str):
+    return await redirect_storyboard(request, video_id, "get_storyboard")
+
+
+@app.get(constant.STORYBOARD_ENDPOINT + "/{video_id}/{sheet_id}")
+async def get_storyboard_sheet(request: Request, video_id: str, sheet_id: str):
+    return await redirect_storyboard(request, video_id, "get_storyboard_sheet")
+
+
+async def redirect_storyboard(request: Request, video_id: str, name: str):
+    if len(FILE_SERVERS) == 0:
+        return JSONResponse(
+            status_code=404,
+            content=jsonable_encoder({constant.MESSAGE_KEY: "file function is not supported"}),
+        )
+
+    crequest = CRequestPool(FILE_MAX_REQUESTS)
+    health_requests = [
+        GetRequest(
+            urljoin(ss["host"], f"{constant.STORYBOARD_HEALTH_ENDPOINT}/{video_id}"),
+            params=request.query_params,
+            timeout=FILE_MAX_REQUESTS,
+        )
+        for ss in FILE_SERVERS
+    ]
+    crequest.map(health_requests)
+
+    try:
+        for future in crequest.as_completed():
+            res = future.result()
+            if res and res.ok:
+                crequest.cancel_all()
+
+                parsed_url = urlparse(res.url)
+                redirected_url = parsed_url._replace(path=request.url.path).geturl()
+                return RedirectResponse(redirected_url)
+    except:
+        return JSONResponse(
+            status_code=500,
+            content=jsonable_encoder({constant.MESSAGE_KEY: f"{name} errors"}),
+        )
+
+    return JSONResponse(
+        status_code=404,
+        content=jsonable_encoder({constant.MESSAGE_KEY: "unavailable"}),
+    )
+
+
 CHUNK_SIZE = 1024 * 1024
 
 
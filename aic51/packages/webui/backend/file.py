@@ -6,16 +6,26 @@ from fastapi.responses import FileResponse, JSONResponse
 
 import aic51.packages.constant as constant
 from aic51.packages.logger import logger
+from aic51.packages.media import DirectoryImageStore, get_storyboard_sheet_path, load_storyboard_index
 
-from .utils import create_app, get_fps
+from .utils import create_app, get_fps, get_thumbnail_store
 
 app = create_app()
 
 
+@app.get(constant.STORYBOARD_HEALTH_ENDPOINT + "/{video_id}")
+async def storyboard_health(request: Request, video_id: str):
+    storyboard_dir = Path.cwd() / constant.STORYBOARD_DIR / video_id
+    if load_storyboard_index(storyboard_dir) is not None:
+        return JSONResponse(status_code=200, content=jsonable_encoder({constant.MESSAGE_KEY: "available"}))
+    else:
+        return JSONResponse(status_code=404, content=jsonable_encoder({constant.MESSAGE_KEY: "unavailable"}))
+
+
 @app.get(constant.HEALTH_ENDPOINT + "/{video_id}/{frame_id}")
 async def frame_health(request: Request, video_id: str, frame_id: str):
-    file_path = Path.cwd() / f"{constant.THUMBNAIL_DIR}/{video_id}/{frame_id}{constant.IMAGE_EXTENSION}"
-    if file_path.exists() and not file_path.is_dir():
+    thumbnail_store = get_thumbnail_store(video_id)
+    if thumbnail_store is not None and frame_id.isdigit() and int(frame_id) in thumbnail_store:
         return JSONResponse(status_code=200, content=jsonable_encoder({constant.MESSAGE_KEY: "available"}))
     else:
         return JSONResponse(status_code=404, content=jsonable_encoder({constant.MESSAGE_KEY: "unavailable"}))
@@ -55,12 +65,33 @@ async def frame_info(request: Request, video_id: str, frame_id: str):
 
 @app.get(constant.FILE_ENDPOINT + "/{video_id}/{frame_id}")
 async def get_file(request: Request, video_id: str, frame_id: str):
-    file_path = Path.cwd() / f"{constant.THUMBNAIL_DIR}/{video_id}/{frame_id}{constant.IMAGE_EXTENSION}"
-    if file_path.exists() and not file_path.is_dir():
-        return FileResponse(file_path)
+    thumbnail_store = get_thumbnail_store(video_id)
+    if thumbnail_store is None or not frame_id.isdigit() or int(frame_id) not in thumbnail_store:
+        return JSONResponse(status_code=404, content=jsonable_encoder({constant.MESSAGE_KEY: "unavailable"}))
+
+    if isinstance(thumbnail_store, DirectoryImageStore):
+        return FileResponse(thumbnail_store.get(int(frame_id)))
     else:
+        return Response(thumbnail_store.read_bytes(int(frame_id)), media_type=constant.IMAGE_MEDIA_TYPE)
+
+
+@app.get(constant.STORYBOARD_ENDPOINT + "/{video_id}")
+async def get_storyboard(request: Request, video_id: str):
+    storyboard_index = load_storyboard_index(Path.cwd() / constant.STORYBOARD_DIR / video_id)
+    if storyboard_index is None:
+        return JSONResponse(status_code=404, content=jsonable_encoder({constant.MESSAGE_KEY: "unavailable"}))
+
+    return JSONResponse(status_code=200, content=jsonable_encoder(storyboard_index))
+
+
+@app.get(constant.STORYBOARD_ENDPOINT + "/{video_id}/{sheet_id}")
+async def get_storyboard_sheet(request: Request, video_id: str, sheet_id: str):
+    storyboard_dir = Path.cwd() / constant.STORYBOARD_DIR / video_id
+    if not sheet_id.isdigit() or not get_storyboard_sheet_path(storyboard_dir, int(sheet_id)).exists():
         return JSONResponse(status_code=404, content=jsonable_encoder({constant.MESSAGE_KEY: "unavailable"}))
 
+    return FileResponse(get_storyboard_sheet_path(storyboard_dir, int(sheet_id)))
+
 
 CHUNK_SIZE = 1024 * 1024
 
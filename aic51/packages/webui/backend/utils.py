@@ -1,6 +1,8 @@
 import concurrent.futures
 import json
 import logging
+from functools import lru_cache
+from pathlib import Path
 from urllib.parse import urljoin, urlparse
 
 import requests
@@ -9,6 +11,7 @@ from fastapi.middleware.cors import CORSMiddleware
 
 import aic51.packages.constant as constant
 from aic51.packages.logger import logger
+from aic51.packages.media import open_image_store
 
 
 def create_app(*args, **kwargs):
@@ -36,6 +39,22 @@ def get_fps(video_id: str):
     return fps
 
 
+def get_thumbnail_store(video_id: str):
+    thumbnail_dir = Path.cwd() / constant.THUMBNAIL_DIR / video_id
+    try:
+        mtime = thumbnail_dir.stat().st_mtime_ns
+    except OSError:
+        return None
+
+    # Stores are reopened when files are added to or renamed in the directory
+    return _open_thumbnail_store(thumbnail_dir, mtime)
+
+
+@lru_cache(maxsize=256)
+def _open_thumbnail_store(thumbnail_dir: Path, mtime: int):
+    return open_image_store(thumbnail_dir)
+
+
 def process_searcher_results(searcher_res: dict):
     frames = []
     for record in searcher_res["results"]: